@@ -6,6 +6,7 @@ from .inserters import (
     RecordingSessionInserter,
 )
 from .recording_session import RecordingSession
+from .batch import BatchRunner
 from .processors import AnalogSignalProcessor
 from .utils import read_json
 from .dal import DAL_ORM, DAL_CORE
@@ -0,0 +1,360 @@
+from .recording_session import RecordingSession, resolve_experimental_paths
+from .inserters import RecordingSessionInserter
+from .errors import DuplicateError, CurruptDataError
+from .continuous_tools import NUM_HEADER_BYTES, RECORD_SIZE, SAMPLES_PER_RECORD
+from .processors import StreamingDecimator, DECIMATION_CHUNK_SIZE, DETECTION_CHUNK_SIZE
+from .continuous_block import ContinuousBlock
+from .signals import AnalogSignal
+from .reference_cache import reference_cache
+from .utils import WAVEFORM_CHUNK_SIZE, _prep_db
+from .logger import logger
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+import numpy as np
+import os
+import time
+
+# memory needed by a session beyond its arrays: interpreter, libraries, dfs
+BASE_SESSION_MEMORY = 512 * 1024 ** 2
+# bytes per decimated sample: timepoint_s and voltage float64, each held by
+# the downsampled array, its df and the df's dropna copy
+DOWNSAMPLED_BYTES_PER_SAMPLE = 6 * 8
+# bytes per decimated sample of the stft: complex128 Zxx, its float64
+# magnitude and the float32 Spectrogram
+STFT_BYTES_PER_SAMPLE = 16 + 8 + 4
+# float64 buffers of a decimation chunk: read, zero padded and filtered
+DECIMATION_BUFFERS = 3
+# bytes per spike of the cluster index, selected spike times and ifr inputs
+SPIKE_BYTES_PER_SPIKE = 8 * 8
+# one int16 window of utils.get_waveforms: 240 samples of 32 channels
+WAVEFORM_WINDOW_BYTES = 240 * 32 * 2
+
+
+def _n_samples(continuous_path):
+    """number of samples of a .continuous file, from its size"""
+    if not os.path.exists(continuous_path):
+        return 0
+    n_bytes = os.path.getsize(continuous_path) - NUM_HEADER_BYTES
+    return max(n_bytes, 0) // RECORD_SIZE * SAMPLES_PER_RECORD
+
+
+def _n_spikes(npy_path):
+    """length of a kilosort .npy output, read from its header"""
+    if not os.path.exists(npy_path):
+        return 0
+    return len(np.load(npy_path, mmap_mode="r"))
+
+
+def _analog_memory(analog_signals, config):
+    """
+    - peak memory of process_analog_signals: the decimated signal and stft
+      of each signal, sized from the decimated output length, plus the
+      buffers of the decimation chunks
+    - signals are processed one at a time unless config["batch_analog"],
+      in which case they are all held at once
+    """
+    per_signal: list = []
+    for signal in analog_signals:
+        decimator = StreamingDecimator(
+            q=int(signal.current_sampling_rate / signal.desired_sampling_rate)
+        )
+        n_out = sum(
+            decimator.output_length(_n_samples(f["file_name"]))
+            for f in signal.file_names.values()
+        )
+        per_signal.append(
+            n_out * (DOWNSAMPLED_BYTES_PER_SAMPLE + STFT_BYTES_PER_SAMPLE)
+        )
+    if not per_signal:
+        return 0
+    chunk_bytes = DECIMATION_CHUNK_SIZE * 8 * DECIMATION_BUFFERS
+    if config.get("batch_analog", False):
+        return sum(per_signal) + chunk_bytes * len(per_signal)
+    return max(per_signal) + chunk_bytes
+
+
+def _discrete_memory(discrete_signals, config):
+    """
+    - peak memory of process_discrete_signals: a detection chunk and its
+      diff per worker for signals detected from analog channels
+    - events themselves are small, or spilled past discrete_max_memory
+    """
+    if not any(signal.get("from_analog") for signal in discrete_signals):
+        return 0
+    return DETECTION_CHUNK_SIZE * 8 * 2 * config.get("discrete_workers", 4)
+
+
+def _spikes_memory(kilosort_dir, config):
+    """
+    - peak memory of process_spikes: spike_times.npy and spike_clusters.npy
+      paged in, the argsort of the cluster index and spike time dfs, plus
+      the waveform windows of each worker or the templates
+    """
+    spike_files = [
+        kilosort_dir.joinpath("spike_times.npy"),
+        kilosort_dir.joinpath("spike_clusters.npy"),
+    ]
+    memory = sum(os.path.getsize(f) for f in spike_files if os.path.exists(f))
+    memory += _n_spikes(spike_files[0]) * SPIKE_BYTES_PER_SPIKE
+    if config.get("waveform_source", "dat") == "templates":
+        templates = kilosort_dir.joinpath("templates.npy")
+        if os.path.exists(templates):
+            memory += os.path.getsize(templates)
+        return memory
+    n_workers = max(config.get("waveform_workers", 1), 1)
+    worker_memory = config.get("waveform_worker_memory")
+    if worker_memory is None:
+        worker_memory = WAVEFORM_CHUNK_SIZE * WAVEFORM_WINDOW_BYTES
+    return memory + n_workers * worker_memory
+
+
+def estimate_session_memory(params, paths):
+    """
+    - rough peak memory of processing a recording session in bytes
+    - params are the RecordingSession params and paths its experimental
+      paths, as from resolve_experimental_paths, so no RecordingSession is
+      built and nothing is read beyond file sizes and .npy headers
+    - the analog, discrete and spike stages run concurrently so their peaks
+      are summed; inputs are streamed or memory-mapped, so each stage is
+      sized from the arrays it builds rather than from its input files
+    """
+    config = params["config"]
+    continuous_blocks = [
+        ContinuousBlock(**block, continuous_prefix=config["continuous_prefix"])
+        for block in params.get("continuous_blocks") or []
+    ]
+    for continuous_block in continuous_blocks:
+        continuous_block.make_dirs_absolute(paths["continuous_home_dir"])
+    analog_signals = [
+        AnalogSignal(**asig, continuous_prefix=config["continuous_prefix"])
+        for asig in params.get("analog_signals") or []
+    ]
+    for asig in analog_signals:
+        asig.make_paths_absolute(continuous_blocks)
+    return int(
+        BASE_SESSION_MEMORY
+        + _analog_memory(analog_signals, config)
+        + _discrete_memory(params.get("discrete_signals") or [], config)
+        + _spikes_memory(paths["kilosort_dir"], config)
+    )
+
+
+def available_memory():
+    """total physical memory in bytes"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _process_and_insert(params, duplicates, insert_lock):
+    """
+    - processes and inserts one recording session in a worker process
+    - inserts are run while holding insert_lock so that only one session
+      writes to the db at a time
+    - returns a report dict with keys: {"session_name", "status", "message",
+      "process_seconds", "insert_seconds"}
+    """
+    session_name = params["meta"]["session_name"]
+    report = {
+        "session_name": session_name,
+        "status": "success",
+        "message": "",
+        "process_seconds": 0.0,
+        "insert_seconds": 0.0,
+    }
+    started = time.perf_counter()
+    recording = RecordingSession(**params, duplicates=duplicates)
+    try:
+        recording.process_data()
+    except DuplicateError as e:
+        if duplicates == "fail":
+            raise
+        report.update(status="skipped", message=str(e))
+        return report
+    except CurruptDataError as e:
+        report.update(status="failed", message=f"corrupt data: {e}")
+        return report
+    finally:
+        report["process_seconds"] = time.perf_counter() - started
+
+    with insert_lock:
+        started = time.perf_counter()
+        inserter = RecordingSessionInserter(recording)
+        inserted = inserter.run_inserts()
+        report["insert_seconds"] = time.perf_counter() - started
+    if not inserted:
+        report.update(status="skipped", message="inserted by another process")
+    return report
+
+
+class BatchRunner:
+    """
+    Processes and inserts many recording sessions in a process pool
+
+    Sessions are started in order while their estimated peak memory fits in
+    max_memory alongside the sessions already running, up to n_workers at a
+    time. A session which would not fit on its own is run once nothing else
+    is. DB inserts are serialised with a lock shared by the workers.
+
+    params:
+        sessions: list of RecordingSession params, as in recording_sessions.json
+        duplicates: duplicate behaviour, "skip", "fail" or "overwrite"
+        n_workers: maximum number of sessions processed at once
+        max_memory: memory budget in bytes, defaults to the physical memory
+
+    methods:
+        run
+        summarise
+    """
+
+    def __init__(self, sessions, duplicates="skip", n_workers=None, max_memory=None):
+        self.sessions = sessions
+        self.duplicates = duplicates
+        self.n_workers = n_workers or os.cpu_count()
+        self.max_memory = max_memory or available_memory()
+        self.reports: list = []
+        self.seconds = 0.0
+        self.Session = None
+
+    def _estimate(self, params):
+        """
+        - estimated memory of a session, from its params and experimental
+          paths looked up in the reference cache
+        """
+        if self.Session is None:
+            _prep_db(self)
+        experiment_name = params["meta"]["experiment_name"]
+        session = self.Session()
+        try:
+            exp_paths = reference_cache.experimental_paths(
+                session, self.orm, experiment_name
+            )
+        finally:
+            session.close()
+        paths = resolve_experimental_paths(
+            exp_paths, experiment_name, params["meta"]["session_name"]
+        )
+        return estimate_session_memory(params, paths)
+
+    def _failed(self, session_name, error):
+        logger.error(f"{self}: {session_name} failed: {error!r}")
+        return {
+            "session_name": session_name,
+            "status": "failed",
+            "message": repr(error),
+            "process_seconds": 0.0,
+            "insert_seconds": 0.0,
+        }
+
+    def _restart_pool(self, executor, running, error):
+        """
+        - reports every session in running as failed with error, shuts down
+          the broken executor and returns a new one
+        """
+        logger.error(f"{self}: process pool broken, restarting: {error!r}")
+        for session_name, _, started in running.values():
+            report = self._failed(session_name, error)
+            report["seconds"] = time.perf_counter() - started
+            self.reports.append(report)
+        running.clear()
+        executor.shutdown(wait=False)
+        return ProcessPoolExecutor(max_workers=self.n_workers)
+
+    def run(self):
+        """
+        - processes and inserts every session, returning a report per session
+        - failures are reported and do not stop the batch, except duplicates
+          when duplicates == "fail"
+        - if a worker dies the sessions running in the pool are reported as
+          failed and the batch continues in a new pool
+        """
+        started_batch = time.perf_counter()
+        pending = [[params, None] for params in self.sessions]
+        running: dict = {}
+        in_use = 0
+        with Manager() as manager:
+            insert_lock = manager.Lock()
+            executor = ProcessPoolExecutor(max_workers=self.n_workers)
+            try:
+                while pending or running:
+                    while pending and len(running) < self.n_workers:
+                        params, estimate = pending[0]
+                        session_name = params["meta"]["session_name"]
+                        if estimate is None:
+                            try:
+                                estimate = pending[0][1] = self._estimate(params)
+                            except Exception as e:
+                                pending.pop(0)
+                                self.reports.append(self._failed(session_name, e))
+                                continue
+                        if running and in_use + estimate > self.max_memory:
+                            break
+                        try:
+                            future = executor.submit(
+                                _process_and_insert,
+                                params,
+                                self.duplicates,
+                                insert_lock,
+                            )
+                        except BrokenProcessPool as e:
+                            executor = self._restart_pool(executor, running, e)
+                            in_use = 0
+                            continue
+                        pending.pop(0)
+                        logger.info(
+                            f"{self}: starting {session_name} "
+                            f"(~{estimate / 1024 ** 3:.1f} GB)"
+                        )
+                        running[future] = (session_name, estimate, time.perf_counter())
+                        in_use += estimate
+
+                    if not running:
+                        continue
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    broken = None
+                    for future in finished:
+                        session_name, estimate, started = running.pop(future)
+                        in_use -= estimate
+                        seconds = time.perf_counter() - started
+                        try:
+                            report = future.result()
+                        except DuplicateError:
+                            for other in running:
+                                other.cancel()
+                            raise
+                        except BrokenProcessPool as e:
+                            broken = e
+                            report = self._failed(session_name, e)
+                        except Exception as e:
+                            report = self._failed(session_name, e)
+                        report["seconds"] = seconds
+                        logger.info(
+                            f"{self}: {session_name} {report['status']} "
+                            f"in {seconds:.1f}s {report['message']}"
+                        )
+                        self.reports.append(report)
+                    if broken is not None:
+                        executor = self._restart_pool(executor, running, broken)
+                        in_use = 0
+            finally:
+                executor.shutdown()
+        self.seconds = time.perf_counter() - started_batch
+        return self.reports
+
+    def summarise(self):
+        """
+        - logs the number of sessions with each status and the wall time
+        - returns the number of failed sessions
+        """
+        statuses = [report["status"] for report in self.reports]
+        logger.info(
+            f"{self}: {statuses.count('success')} inserted, "
+            f"{statuses.count('skipped')} skipped, "
+            f"{statuses.count('failed')} failed in {self.seconds:.1f}s"
+        )
+        for report in self.reports:
+            if report["status"] == "failed":
+                logger.error(f"{self}: {report['session_name']}: {report['message']}")
+        return statuses.count("failed")
+
+    def __repr__(self):
+        return f"<BatchRunner: {len(self.sessions)} sessions>"
@@ -0,0 +1,104 @@
+from .logger import logger
+from .errors import BulkInsertError
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, InternalError
+import tempfile
+import os
+
+# rows per executemany when LOAD DATA is not available
+BULK_INSERT_CHUNK_SIZE = 50000
+# mysql error codes meaning LOAD DATA LOCAL INFILE was refused:
+# ER_NOT_ALLOWED_COMMAND, ER_CLIENT_LOCAL_FILES_DISABLED and
+# CR_LOAD_DATA_LOCAL_INFILE_REJECTED
+LOCAL_INFILE_REFUSED = (1148, 3948, 2068)
+
+# engines whose server refused LOCAL INFILE, so it is only tried once each
+_refused_engines: set = set()
+
+
+def bulk_insert(session, table, df, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    """
+    Inserts the rows of df into table in the session's transaction
+
+    - on mysql+pymysql the rows are written to a temporary tsv and loaded
+      with LOAD DATA LOCAL INFILE
+    - otherwise, or if the server refuses LOCAL INFILE, they are inserted
+      with executemany, chunk_size rows at a time; a refusal is remembered
+      for the engine so LOAD DATA is not tried on it again
+    - any other error, e.g. a deadlock which has already rolled back the
+      transaction, is raised
+    - raises BulkInsertError if LOAD DATA skips or alters any row, so the
+      transaction is rolled back rather than committed incomplete
+
+    params:
+        session: sqlalchemy session
+        table: orm class or Table to insert into
+        df: pandas df whose columns are columns of table
+        chunk_size: rows per executemany
+    """
+    table = getattr(table, "__table__", table)
+    if len(df) == 0:
+        return
+    connection = session.connection()
+    dialect = connection.dialect
+    if (
+        dialect.name == "mysql"
+        and dialect.driver == "pymysql"
+        and connection.engine not in _refused_engines
+    ):
+        try:
+            _load_data_local_infile(connection, table, df)
+            return
+        except (OperationalError, InternalError) as e:
+            if not e.orig.args or e.orig.args[0] not in LOCAL_INFILE_REFUSED:
+                raise
+            _refused_engines.add(connection.engine)
+            logger.warning(
+                f"bulk_insert: LOAD DATA LOCAL INFILE refused by "
+                f"{connection.engine.url.host}, using executemany: {e}"
+            )
+    _executemany(connection, table, df, chunk_size)
+
+
+def _load_data_local_infile(connection, table, df):
+    quote = connection.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column) for column in df.columns)
+    # to_csv ends lines with os.linesep and writes booleans as True/False
+    line_terminator = os.linesep.encode("unicode_escape").decode()
+    booleans = df.select_dtypes(bool).columns
+    df = df.astype({column: int for column in booleans})
+    fd, path = tempfile.mkstemp(suffix=".tsv")
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            df.to_csv(f, sep="\t", header=False, index=False, na_rep="\\N")
+        logger.debug(f"bulk_insert: loading {len(df)} rows into {table.name}")
+        result = connection.execute(
+            text(
+                f"LOAD DATA LOCAL INFILE :path INTO TABLE {quote(table.name)} "
+                f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '{line_terminator}' "
+                f"({columns})"
+            ),
+            {"path": path},
+        )
+    finally:
+        os.remove(path)
+    # LOCAL turns errors such as duplicate keys or bad values into warnings,
+    # skipping or truncating the row as with IGNORE
+    warnings = [
+        tuple(warning)
+        for warning in connection.execute(text("SHOW WARNINGS")).fetchall()
+        if warning[0] != "Note"
+    ]
+    if result.rowcount != len(df) or warnings:
+        raise BulkInsertError(
+            f"LOAD DATA LOCAL INFILE loaded {result.rowcount} of {len(df)} rows "
+            f"into {table.name}, warnings: {warnings[:10]}"
+        )
+
+
+def _executemany(connection, table, df, chunk_size):
+    logger.debug(f"bulk_insert: inserting {len(df)} rows into {table.name}")
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start : start + chunk_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        connection.execute(table.insert(), chunk.to_dict(orient="records"))
@@ -0,0 +1,105 @@
+from .logger import logger
+from pathlib import Path
+from threading import Lock
+import numpy as np
+import hashlib
+import json
+import os
+
+# bump when a change to the processing code invalidates existing checkpoints
+CHECKPOINT_VERSION = 1
+
+
+def _to_builtin(value):
+    """json default for numpy scalars and paths"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, Path):
+        return str(value)
+    raise TypeError(f"Cannot serialise {value!r}")
+
+
+class CheckpointManifest:
+    """
+    Record of the finished processing stages of a recording session
+
+    Kept as a json file in extracted_dir mapping each stage to a fingerprint
+    of its inputs, the files it wrote and any state needed to restore it. A
+    stage whose fingerprint is unchanged and whose outputs still exist can be
+    restored from the manifest rather than rerun.
+
+    params:
+        path: path of the manifest json
+        enabled: if False nothing is restored or recorded
+
+    methods:
+        fingerprint
+        restore
+        save
+    """
+
+    def __init__(self, path, enabled=True):
+        self.path = Path(path)
+        self.enabled = enabled
+        self._lock = Lock()
+        self._stages: dict = {}
+        if self.enabled and self.path.exists():
+            with open(self.path) as f:
+                self._stages = json.load(f)
+
+    @staticmethod
+    def fingerprint(paths, **config):
+        """
+        - hash of the path, size and mtime of each input file and of config
+        - missing files are included as such
+        """
+        files: list = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                files.append([str(path), stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                files.append([str(path), None, None])
+        key = json.dumps(
+            {"version": CHECKPOINT_VERSION, "files": files, "config": config},
+            sort_keys=True,
+            default=_to_builtin,
+        )
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def restore(self, stage, fingerprint):
+        """
+        - returns the state saved for stage if its fingerprint matches and
+          all of its outputs exist, otherwise None
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            checkpoint = self._stages.get(stage)
+        if checkpoint is None or checkpoint["fingerprint"] != fingerprint:
+            return None
+        if not all(os.path.exists(path) for path in checkpoint["outputs"]):
+            return None
+        logger.info(f"{self}: restoring {stage}")
+        return checkpoint["state"]
+
+    def save(self, stage, fingerprint, state=None, outputs=()):
+        """
+        - records stage as finished with the given fingerprint, state and
+          output files, and rewrites the manifest
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._stages[stage] = {
+                "fingerprint": fingerprint,
+                "state": state or {},
+                "outputs": [str(path) for path in outputs],
+            }
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(self._stages, f, indent=2, default=_to_builtin)
+            os.replace(tmp_path, self.path)
+
+    def __repr__(self):
+        return f"<CheckpointManifest: {self.path.name}>"
@@ -1,5 +1,5 @@
 from .utils import make_filename
-from .continuous_tools import loadContinuous
+from .continuous_tools import loadContinuous, ContinuousFile
 from .logger import logger
 
 
@@ -20,5 +20,12 @@ class ContinuousBlock:
         logger.debug(f"{self}.load_continuous_channel: {fname}")
         return loadContinuous(fname)["data"].flatten()
 
+    def open_continuous_channel(self, ch="CH3", dtype=float, salvage=False):
+        fname = self.path.joinpath(
+            make_filename(self.continuous_prefix, ch, ext=".continuous")
+        )
+        logger.debug(f"{self}.open_continuous_channel: {fname}")
+        return ContinuousFile(fname, dtype=dtype, salvage=salvage)
+
     def __repr__(self):
         return f"<ContinuousBlock: {self.dir_name}>"
@@ -17,7 +17,7 @@ import numpy as np
 import scipy.signal
 import scipy.io
 import time
-import struct
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 # constants
@@ -29,10 +29,45 @@ RECORD_SIZE = (
 )  # size of each continuous record in bytes
 RECORD_MARKER = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 255])
 
-# constants for pre-allocating matrices:
-MAX_NUMBER_OF_SPIKES = int(1e6)
-MAX_NUMBER_OF_RECORDS = int(1e6)
-MAX_NUMBER_OF_EVENTS = int(1e6)
+# layout of a single continuous record
+CONTINUOUS_RECORD_DTYPE = np.dtype(
+    [
+        ("timestamp", "<i8"),  # little-endian 64-bit signed integer
+        ("N", "<u2"),  # little-endian 16-bit unsigned integer
+        ("recordingNumber", ">u2"),  # big-endian 16-bit unsigned integer
+        ("data", ">i2", SAMPLES_PER_RECORD),  # big-endian 16-bit signed integer
+        ("marker", "<u1", 10),
+    ]
+)
+
+# default memory budget, in bytes, for the chunks written by pack
+PACK_MAX_MEMORY = 256 * 1024 ** 2
+
+# layout of a single .events record
+EVENT_RECORD_DTYPE = np.dtype(
+    [
+        ("timestamps", "<i8"),
+        ("sampleNum", "<i2"),
+        ("eventType", "<u1"),
+        ("nodeId", "<u1"),
+        ("eventId", "<u1"),
+        ("channel", "<u1"),
+        ("recordingNumber", "<u2"),
+    ]
+)
+
+# fixed-size start of each .spikes record, the rest depends on its channel count
+SPIKE_PREAMBLE_DTYPE = np.dtype(
+    [
+        ("eventType", "<u1"),  # always equal to 4
+        ("timestamps", "<i8"),
+        ("software_timestamp", "<i8"),
+        ("source", "<u2"),
+        ("numChannels", "<u2"),
+        ("numSamples", "<u2"),
+        ("sortedId", "<u2"),
+    ]
+)
 
 
 def load(filepath, dtype=float):
@@ -52,9 +87,10 @@ def load(filepath, dtype=float):
     return data
 
 
-def loadFolder(folderpath, dtype=float, **kwargs):
+def loadFolder(folderpath, dtype=float, n_workers=1, **kwargs):
 
     # load all continuous files in a folder
+    # n_workers > 1 loads files concurrently in a thread pool
 
     data = {}
 
@@ -63,16 +99,18 @@ def loadFolder(folderpath, dtype=float, **kwargs):
         filelist = ["100_CH" + x + ".continuous" for x in map(str, kwargs["channels"])]
     else:
         filelist = os.listdir(folderpath)
+    filelist = [f for f in filelist if ".continuous" in f]
 
     t0 = time.time()
-    numFiles = 0
+    numFiles = len(filelist)
 
-    for i, f in enumerate(filelist):
-        if ".continuous" in f:
-            data[f.replace(".continuous", "")] = loadContinuous(
-                os.path.join(folderpath, f), dtype=dtype
-            )
-            numFiles += 1
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        loaded = executor.map(
+            lambda f: loadContinuous(os.path.join(folderpath, f), dtype=dtype),
+            filelist,
+        )
+        for f, ch in zip(filelist, loaded):
+            data[f.replace(".continuous", "")] = ch
 
     print("".join(("Avg. Load Time: ", str((time.time() - t0) / numFiles), " sec")))
     print("".join(("Total Load Time: ", str((time.time() - t0)), " sec")))
@@ -81,43 +119,44 @@ def loadFolder(folderpath, dtype=float, **kwargs):
 
 
 def loadFolderToArray(
-    folderpath, channels="all", chprefix="CH", dtype=float, session="0", source="100"
+    folderpath,
+    channels="all",
+    chprefix="CH",
+    dtype=float,
+    session="0",
+    source="100",
+    n_workers=1,
 ):
     """Load continuous files in specified folder to a single numpy array. By default all
     CH continous files are loaded in numerical order, ordering can be specified with
-    optional channels argument which should be a list of channel numbers."""
+    optional channels argument which should be a list of channel numbers.
+
+    The array is sized from file metadata and each channel is decoded straight into
+    its column, by n_workers threads concurrently if n_workers > 1."""
 
     if channels == "all":
         channels = _get_sorted_channels(folderpath, chprefix, session, source)
 
-    if session == "0":
-        filelist = [
-            source + "_" + chprefix + x + ".continuous" for x in map(str, channels)
-        ]
-    else:
-        filelist = [
-            source + "_" + chprefix + x + "_" + session + ".continuous"
-            for x in map(str, channels)
-        ]
+    filelist = _continuous_filelist(channels, chprefix, session, source)
 
     t0 = time.time()
-    numFiles = 1
-
-    channel_1_data = loadContinuous(os.path.join(folderpath, filelist[0]), dtype)[
-        "data"
-    ]
+    numFiles = len(filelist)
 
-    n_samples = len(channel_1_data)
-    n_channels = len(filelist)
+    files = [ContinuousFile(os.path.join(folderpath, f), dtype) for f in filelist]
+    n_samples = files[0].n_samples
+    n_channels = len(files)
+    if any(f.n_samples != n_samples for f in files):
+        raise CurruptDataError(
+            "Continuous files in " + str(folderpath) + " differ in length"
+        )
 
     data_array = np.zeros([n_samples, n_channels], dtype)
-    data_array[:, 0] = channel_1_data
 
-    for i, f in enumerate(filelist[1:]):
-        data_array[:, i + 1] = loadContinuous(os.path.join(folderpath, f), dtype)[
-            "data"
-        ]
-        numFiles += 1
+    def decode_column(i):
+        files[i].read(0, n_samples, out=data_array[:, i])
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(decode_column, range(n_channels)))
 
     print("".join(("Avg. Load Time: ", str((time.time() - t0) / numFiles), " sec")))
     print("".join(("Total Load Time: ", str((time.time() - t0)), " sec")))
@@ -125,7 +164,14 @@ def loadFolderToArray(
     return data_array
 
 
-def loadContinuous(filepath, dtype=float):
+def loadContinuous(filepath, dtype=float, salvage=False):
+    """
+    Loads a .continuous file
+
+    If salvage is True corrupt records do not raise CurruptDataError. Their
+    samples and timestamps are NaN (0 for np.int16 data, see "valid_records")
+    and ch["integrity"] holds the report from check_integrity.
+    """
 
     assert dtype in (
         float,
@@ -135,69 +181,253 @@ def loadContinuous(filepath, dtype=float):
     ch = {}
 
     # read in the data
-    f = open(filepath, "rb")
+    with open(filepath, "rb") as f:
 
-    fileLength = os.fstat(f.fileno()).st_size
+        fileLength = os.fstat(f.fileno()).st_size
 
-    # calculate number of samples
-    recordBytes = fileLength - NUM_HEADER_BYTES
-    if recordBytes % RECORD_SIZE != 0:
-        raise CurruptDataError(
-            "File size is not consistent with a continuous file: may be corrupt"
+        # calculate number of records
+        recordBytes = fileLength - NUM_HEADER_BYTES
+        if recordBytes % RECORD_SIZE != 0 and not salvage:
+            raise CurruptDataError(
+                "File size is not consistent with a continuous file: may be corrupt"
+            )
+        nrec = max(recordBytes, 0) // RECORD_SIZE
+
+        header = readHeader(f)
+
+        # one bulk read of the whole record region, viewed as structured records
+        records = np.fromfile(f, CONTINUOUS_RECORD_DTYPE, nrec)
+
+    bad = _bad_records(records)
+    if not salvage:
+        _raise_if_bad(bad)
+
+    ch["header"] = header
+    ch["timestamps"] = records["timestamp"].astype(np.float64)
+    ch["data"] = _decode_samples(records["data"].reshape(-1), header, dtype)
+    ch["recordingNumber"] = records["recordingNumber"].astype(np.float64)
+    if salvage:
+        ch["timestamps"][bad] = np.nan
+        _fill_bad_samples(ch["data"], bad)
+        ch["valid_records"] = ~bad
+        ch["integrity"] = check_integrity(
+            records, truncated_bytes=max(recordBytes, 0) % RECORD_SIZE
         )
-    nrec = recordBytes // RECORD_SIZE
-    nsamp = nrec * SAMPLES_PER_RECORD
-    # pre-allocate samples
-    samples = np.zeros(nsamp, dtype)
-    timestamps = np.zeros(nrec)
-    recordingNumbers = np.zeros(nrec)
-    indices = np.arange(0, nsamp + 1, SAMPLES_PER_RECORD, np.dtype(np.int64))
+    return ch
+
 
-    header = readHeader(f)
+def check_integrity(records, truncated_bytes=0):
+    """
+    Checks every record header and marker in one vectorized pass
+
+    params:
+        records: array of CONTINUOUS_RECORD_DTYPE records
+        truncated_bytes: bytes left over after the last whole record
+    returns a dict with keys:
+        - "n_records": number of whole records
+        - "bad_records": indices of records with a bad sample count or marker
+        - "discontinuities": indices of good records whose timestamp does not
+          follow on from the previous good record
+        - "dropped_records": number of records missing according to the
+          timestamp deltas between good records
+        - "truncated_bytes": as passed
+    """
+    bad = _bad_records(records)
+    good = np.flatnonzero(~bad)
+    timestamps = records["timestamp"][good].astype(np.int64)
+    expected = np.diff(good) * SAMPLES_PER_RECORD
+    deltas = np.diff(timestamps)
+    jumps = deltas != expected
+    missing = (deltas - expected) // SAMPLES_PER_RECORD
+    return {
+        "n_records": len(records),
+        "bad_records": np.flatnonzero(bad),
+        "discontinuities": good[1:][jumps],
+        "dropped_records": int(missing[missing > 0].sum()),
+        "truncated_bytes": int(truncated_bytes),
+    }
+
+
+def _bad_records(records):
+    """boolean mask of records with a bad sample count or marker"""
+    return (records["N"] != SAMPLES_PER_RECORD) | np.any(
+        records["marker"] != RECORD_MARKER, axis=1
+    )
 
-    recIndices = np.arange(0, nrec)
 
-    for recordNumber in recIndices:
+def _raise_if_bad(bad, first_record=0):
+    if bad.any():
+        raise CurruptDataError(
+            "Found corrupted record in block " + str(first_record + np.argmax(bad))
+        )
 
-        timestamps[recordNumber] = np.fromfile(
-            f, np.dtype("<i8"), 1
-        )  # little-endian 64-bit signed integer
-        N = np.fromfile(f, np.dtype("<u2"), 1)[
-            0
-        ]  # little-endian 16-bit unsigned integer
 
-        # print index
+def _check_records(records, first_record=0):
+    """Raises CurruptDataError if any record has a bad sample count or marker"""
+    _raise_if_bad(_bad_records(records), first_record)
 
-        if N != SAMPLES_PER_RECORD:
-            raise CurruptDataError(
-                "Found corrupted record in block " + str(recordNumber)
-            )
 
-        recordingNumbers[recordNumber] = np.fromfile(
-            f, np.dtype(">u2"), 1
-        )  # big-endian 16-bit unsigned integer
+def _fill_bad_samples(samples, bad, offset=0):
+    """Sets the samples of bad records to NaN, or 0 for integer samples"""
+    if not bad.any():
+        return
+    bad_samples = np.repeat(bad, SAMPLES_PER_RECORD)[offset : offset + len(samples)]
+    samples[bad_samples] = 0 if samples.dtype == np.int16 else np.nan
 
-        if dtype == float:  # Convert data to float array and convert bits to voltage.
-            data = np.fromfile(f, np.dtype(">i2"), N) * float(
-                header["bitVolts"]
-            )  # big-endian 16-bit signed integer, multiplied by bitVolts
-        else:  # Keep data in signed 16 bit integer format.
-            data = np.fromfile(
-                f, np.dtype(">i2"), N
-            )  # big-endian 16-bit signed integer
-        samples[indices[recordNumber] : indices[recordNumber + 1]] = data
 
-        marker = f.read(10)  # dump
+def _decode_samples(samples, header, dtype=float, out=None):
+    """
+    Converts big-endian samples to dtype, scaling to volts unless dtype is np.int16.
+    If out is given the samples are decoded into it.
+    """
+    dtype = np.dtype(dtype)
+    if out is None:
+        out = np.empty(len(samples), dtype)
+    if dtype == np.int16:  # Keep data in signed 16 bit integer format.
+        np.copyto(out, samples)
+    # Convert data to float array and convert bits to voltage.
+    elif dtype == np.float64:
+        np.multiply(samples, float(header["bitVolts"]), out=out)
+    else:
+        np.copyto(out, samples)
+        out *= dtype.type(header["bitVolts"])
+    return out
 
-    # print recordNumber
-    # print index
 
-    ch["header"] = header
-    ch["timestamps"] = timestamps
-    ch["data"] = samples  # OR use downsample(samples,1), to save space
-    ch["recordingNumber"] = recordingNumbers
-    f.close()
-    return ch
+class ContinuousFile:
+    """
+    Memory-mapped view of a .continuous file
+
+    Nothing but the header is read on construction. Indexing with a sample
+    range decodes only the records that range touches, so single samples or
+    short windows of multi-GB channels can be read without loading the channel.
+
+    params:
+        filepath: path to the .continuous file
+        dtype: one of float, np.float64, np.float32 (scaled to volts) or
+               np.int16 (raw)
+        salvage: if True, corrupt records read as NaN (0 for np.int16) instead
+                 of raising CurruptDataError and a partial trailing record is
+                 ignored. See integrity.
+
+    usage:
+        cf = ContinuousFile(fname, dtype=np.float32)
+        cf.n_samples, cf.first_timestamp, cf.header["bitVolts"]
+        cf[30000:60000]
+    """
+
+    def __init__(self, filepath, dtype=float, salvage=False):
+        assert np.dtype(dtype) in (
+            np.float64,
+            np.float32,
+            np.int16,
+        ), "Invalid data type specified for ContinuousFile, valid types are float, np.float32 and np.int16"
+        self.filepath = filepath
+        self.dtype = dtype
+        self.salvage = salvage
+
+        recordBytes = os.path.getsize(filepath) - NUM_HEADER_BYTES
+        if (recordBytes < 0 or recordBytes % RECORD_SIZE != 0) and not salvage:
+            raise CurruptDataError(
+                "File size is not consistent with a continuous file: may be corrupt"
+            )
+        self.n_records = max(recordBytes, 0) // RECORD_SIZE
+        self.truncated_bytes = max(recordBytes, 0) % RECORD_SIZE
+
+        with open(filepath, "rb") as f:
+            self.header = readHeader(f)
+
+        if self.n_records:
+            self.records = np.memmap(
+                filepath,
+                dtype=CONTINUOUS_RECORD_DTYPE,
+                mode="r",
+                offset=NUM_HEADER_BYTES,
+                shape=(self.n_records,),
+            )
+        else:
+            self.records = np.zeros(0, CONTINUOUS_RECORD_DTYPE)
+
+    @property
+    def n_samples(self):
+        return self.n_records * SAMPLES_PER_RECORD
+
+    @property
+    def sampling_rate(self):
+        return float(self.header["sampleRate"])
+
+    @property
+    def first_timestamp(self):
+        """timestamp of the first sample in the file, None if it has no records"""
+        if self.n_records == 0:
+            return None
+        if self.salvage:
+            good = self._good_records()
+            return int(
+                self.records[good[0]]["timestamp"] - good[0] * SAMPLES_PER_RECORD
+            )
+        _check_records(self.records[:1])
+        return int(self.records[0]["timestamp"])
+
+    @property
+    def last_timestamp(self):
+        """timestamp of the final sample in the file, None if it has no records"""
+        if self.n_records == 0:
+            return None
+        if self.salvage:
+            good = self._good_records()
+            remaining = self.n_records - good[-1]
+            return int(
+                self.records[good[-1]]["timestamp"] + remaining * SAMPLES_PER_RECORD - 1
+            )
+        _check_records(self.records[-1:], first_record=self.n_records - 1)
+        return int(self.records[-1]["timestamp"]) + SAMPLES_PER_RECORD - 1
+
+    def _good_records(self):
+        good = np.flatnonzero(~_bad_records(self.records))
+        if len(good) == 0:
+            raise CurruptDataError("No valid records in " + str(self.filepath))
+        return good
+
+    def integrity(self):
+        """Integrity report over every record, see check_integrity"""
+        return check_integrity(self.records, truncated_bytes=self.truncated_bytes)
+
+    def read(self, start, stop, dtype=None, out=None):
+        """
+        Returns samples [start, stop) decoding only the records they fall in.
+        If out is given the samples are decoded into it.
+        """
+        dtype = self.dtype if dtype is None else dtype
+        start, stop = max(start, 0), min(stop, self.n_samples)
+        if stop <= start:
+            return _decode_samples(np.zeros(0, ">i2"), self.header, dtype, out)
+        first_record = start // SAMPLES_PER_RECORD
+        last_record = -(-stop // SAMPLES_PER_RECORD)
+        records = self.records[first_record:last_record]
+        bad = _bad_records(records)
+        if not self.salvage:
+            _raise_if_bad(bad, first_record=first_record)
+        offset = start - first_record * SAMPLES_PER_RECORD
+        samples = records["data"].reshape(-1)[offset : offset + stop - start]
+        out = _decode_samples(samples, self.header, dtype, out)
+        _fill_bad_samples(out, bad, offset)
+        return out
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n_samples)
+            if step < 0:
+                return self.read(stop + 1, start + 1)[::step]
+            return self.read(start, stop)[::step]
+        index = range(self.n_samples)[key]
+        return self.read(index, index + 1)[0]
+
+    def __repr__(self):
+        return f"<ContinuousFile: {self.filepath}>"
 
 
 def loadSpikes(filepath):
@@ -211,115 +441,102 @@ def loadSpikes(filepath):
 
     print("loading spikes...")
 
-    f = open(filepath, "rb")
-    header = readHeader(f)
+    with open(filepath, "rb") as f:
+        header = readHeader(f)
 
-    if float(header[" version"]) < 0.4:
+        if float(header[" version"]) < 0.4:
+            raise Exception(
+                "Loader is only compatible with .spikes files with version 0.4 or higher"
+            )
+
+        # record size depends on the channel and sample counts of the first record
+        first = np.frombuffer(f.read(SPIKE_PREAMBLE_DTYPE.itemsize), np.uint8)
+        if len(first) == SPIKE_PREAMBLE_DTYPE.itemsize:
+            first = first.view(SPIKE_PREAMBLE_DTYPE)[0]
+            numChannels = int(first["numChannels"])
+            numSamples = int(first["numSamples"])
+        else:
+            numChannels = int(header["num_channels"])
+            numSamples = 40  # **NOT CURRENTLY WRITTEN TO HEADER**
+        record_dtype = _spike_record_dtype(numChannels, numSamples)
+
+        f.seek(NUM_HEADER_BYTES)
+        nspikes = (
+            os.fstat(f.fileno()).st_size - NUM_HEADER_BYTES
+        ) // record_dtype.itemsize
+        records = np.fromfile(f, record_dtype, nspikes)
+
+    if np.any(records["numChannels"] != numChannels) or np.any(
+        records["numSamples"] != numSamples
+    ):
         raise Exception(
-            "Loader is only compatible with .spikes files with version 0.4 or higher"
+            "Loader is only compatible with .spikes files with a constant number of channels and samples"
         )
 
+    gain = records["gain"].astype(np.float32)
+
+    # convert waveforms to microvolts and order as [spike, sample, channel]
+    waveforms_uv = records["waveforms"].astype(float)
+    waveforms_uv -= 32768
+    waveforms_uv /= gain.astype(float)[:, :, np.newaxis] * 1000
+
     data["header"] = header
-    numChannels = int(header["num_channels"])
-    numSamples = 40  # **NOT CURRENTLY WRITTEN TO HEADER**
-
-    spikes = np.zeros((MAX_NUMBER_OF_SPIKES, numSamples, numChannels))
-    timestamps = np.zeros(MAX_NUMBER_OF_SPIKES)
-    source = np.zeros(MAX_NUMBER_OF_SPIKES)
-    gain = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    thresh = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    sortedId = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    recNum = np.zeros(MAX_NUMBER_OF_SPIKES)
-
-    currentSpike = 0
-
-    while f.tell() < os.fstat(f.fileno()).st_size:
-        eventType = np.fromfile(f, np.dtype("<u1"), 1)  # always equal to 4, discard
-        timestamps[currentSpike] = np.fromfile(f, np.dtype("<i8"), 1)
-        software_timestamp = np.fromfile(f, np.dtype("<i8"), 1)
-        source[currentSpike] = np.fromfile(f, np.dtype("<u2"), 1)
-        numChannels = np.fromfile(f, np.dtype("<u2"), 1)[0]
-        numSamples = np.fromfile(f, np.dtype("<u2"), 1)[0]
-        sortedId[currentSpike] = np.fromfile(f, np.dtype("<u2"), 1)
-        electrodeId = np.fromfile(f, np.dtype("<u2"), 1)
-        channel = np.fromfile(f, np.dtype("<u2"), 1)
-        color = np.fromfile(f, np.dtype("<u1"), 3)
-        pcProj = np.fromfile(f, np.float32, 2)
-        sampleFreq = np.fromfile(f, np.dtype("<u2"), 1)
-
-        waveforms = np.fromfile(f, np.dtype("<u2"), numChannels * numSamples)
-        gain[currentSpike, :] = np.fromfile(f, np.float32, numChannels)
-        thresh[currentSpike, :] = np.fromfile(f, np.dtype("<u2"), numChannels)
-        recNum[currentSpike] = np.fromfile(f, np.dtype("<u2"), 1)
-
-        waveforms_reshaped = np.reshape(waveforms, (numChannels, numSamples))
-        waveforms_reshaped = waveforms_reshaped.astype(float)
-        waveforms_uv = waveforms_reshaped
-
-        for ch in range(numChannels):
-            waveforms_uv[ch, :] -= 32768
-            waveforms_uv[ch, :] /= gain[currentSpike, ch] * 1000
-
-        spikes[currentSpike] = waveforms_uv.T
-
-        currentSpike += 1
-
-    data["spikes"] = spikes[:currentSpike, :, :]
-    data["timestamps"] = timestamps[:currentSpike]
-    data["source"] = source[:currentSpike]
-    data["gain"] = gain[:currentSpike, :]
-    data["thresh"] = thresh[:currentSpike, :]
-    data["recordingNumber"] = recNum[:currentSpike]
-    data["sortedId"] = sortedId[:currentSpike]
+    data["spikes"] = waveforms_uv.transpose(0, 2, 1)
+    data["timestamps"] = records["timestamps"].astype(np.int64)
+    data["source"] = records["source"].astype(np.uint16)
+    data["gain"] = gain
+    data["thresh"] = records["thresh"].astype(np.uint16)
+    data["recordingNumber"] = records["recordingNumber"].astype(np.uint16)
+    data["sortedId"] = records["sortedId"].astype(np.uint16)
 
     return data
 
 
+def _spike_record_dtype(numChannels, numSamples):
+    """layout of a single .spikes record holding numChannels x numSamples samples"""
+    return np.dtype(
+        SPIKE_PREAMBLE_DTYPE.descr
+        + [
+            ("electrodeId", "<u2"),
+            ("channel", "<u2"),
+            ("color", "<u1", 3),
+            ("pcProj", "<f4", 2),
+            ("sampleFreq", "<u2"),
+            ("waveforms", "<u2", (numChannels, numSamples)),
+            ("gain", "<f4", numChannels),
+            ("thresh", "<u2", numChannels),
+            ("recordingNumber", "<u2"),
+        ]
+    )
+
+
 def loadEvents(filepath):
 
     data = {}
 
     print("loading events...")
 
-    f = open(filepath, "rb")
-    header = readHeader(f)
-
-    if float(header[" version"]) < 0.4:
-        raise Exception(
-            "Loader is only compatible with .events files with version 0.4 or higher"
-        )
-
-    data["header"] = header
-
-    index = -1
-
-    channel = np.zeros(MAX_NUMBER_OF_EVENTS)
-    timestamps = np.zeros(MAX_NUMBER_OF_EVENTS)
-    sampleNum = np.zeros(MAX_NUMBER_OF_EVENTS)
-    nodeId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventType = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    recordingNumber = np.zeros(MAX_NUMBER_OF_EVENTS)
+    with open(filepath, "rb") as f:
+        header = readHeader(f)
 
-    while f.tell() < os.fstat(f.fileno()).st_size:
-
-        index += 1
+        if float(header[" version"]) < 0.4:
+            raise Exception(
+                "Loader is only compatible with .events files with version 0.4 or higher"
+            )
 
-        timestamps[index] = np.fromfile(f, np.dtype("<i8"), 1)
-        sampleNum[index] = np.fromfile(f, np.dtype("<i2"), 1)
-        eventType[index] = np.fromfile(f, np.dtype("<u1"), 1)
-        nodeId[index] = np.fromfile(f, np.dtype("<u1"), 1)
-        eventId[index] = np.fromfile(f, np.dtype("<u1"), 1)
-        channel[index] = np.fromfile(f, np.dtype("<u1"), 1)
-        recordingNumber[index] = np.fromfile(f, np.dtype("<u2"), 1)
+        nevents = (
+            os.fstat(f.fileno()).st_size - NUM_HEADER_BYTES
+        ) // EVENT_RECORD_DTYPE.itemsize
+        events = np.fromfile(f, EVENT_RECORD_DTYPE, nevents)
 
-    data["channel"] = channel[:index]
-    data["timestamps"] = timestamps[:index]
-    data["eventType"] = eventType[:index]
-    data["nodeId"] = nodeId[:index]
-    data["eventId"] = eventId[:index]
-    data["recordingNumber"] = recordingNumber[:index]
-    data["sampleNum"] = sampleNum[:index]
+    data["header"] = header
+    data["channel"] = events["channel"].astype(np.uint8)
+    data["timestamps"] = events["timestamps"].astype(np.int64)
+    data["eventType"] = events["eventType"].astype(np.uint8)
+    data["nodeId"] = events["nodeId"].astype(np.uint8)
+    data["eventId"] = events["eventId"].astype(np.uint8)
+    data["recordingNumber"] = events["recordingNumber"].astype(np.uint16)
+    data["sampleNum"] = events["sampleNum"].astype(np.int16)
 
     return data
 
@@ -349,61 +566,167 @@ def pack(folderpath, source="100", **kwargs):
     #   dref: int specifying a channel # to use as a digital reference. is subtracted from all channels.
     #   order: the order in which the .continuos files are packed into the .DAT. should be a list of .continious channel numbers. length must equal total channels.
     #   suffix: appended to .DAT filename, which is openephys.DAT if no suffix provided.
+    #   max_memory: approximate number of bytes held in memory at once while packing.
+
+    # add a suffix, if one was specified
+    suffix = kwargs.get("suffix", "")
+    outpath = os.path.join(folderpath, "".join(("openephys", suffix, ".dat")))
+    max_memory = kwargs.get("max_memory", PACK_MAX_MEMORY)
 
-    # load the openephys data into memory
     if "data" not in kwargs.keys():
-        if "channels" not in kwargs.keys():
-            data = loadFolder(folderpath, dtype=np.int16)
+        channels = kwargs.get("order", kwargs.get("channels", "all"))
+        return pack_chunked(
+            folderpath,
+            outpath,
+            channels=channels,
+            dref=kwargs.get("dref"),
+            source=source,
+            max_memory=max_memory,
+        )
+
+    # pack pre-loaded data, in the specified order
+    data = kwargs["data"]
+    order = kwargs.get("order", list(data))
+    random_datakey = next(iter(data))
+    columns = []
+    for channel in order:
+        if source in random_datakey:
+            columns.append(data[channel]["data"])
         else:
-            data = loadFolder(folderpath, dtype=np.int16, channels=kwargs["channels"])
-    else:
-        data = kwargs["data"]
-    # if specified, do the digital referencing
+            columns.append(
+                data["".join(("CH", str(channel).replace("CH", "")))]["data"]
+            )
+    readers = [
+        [lambda start, stop, column=column: column[start:stop] for column in columns]
+    ]
+    n_samples = [len(columns[0])]
+
+    reference = None
     if "dref" in kwargs.keys():
-        ref = load(
+        ref = ContinuousFile(
             os.path.join(
                 folderpath, "".join((source, "_CH", str(kwargs["dref"]), ".continuous"))
-            )
+            ),
+            dtype=np.int16,
         )
-        for i, channel in enumerate(data.keys()):
-            data[channel]["data"] = data[channel]["data"] - ref["data"]
-    # specify the order the channels are written in
-    if "order" in kwargs.keys():
-        order = kwargs["order"]
-    else:
-        order = list(data)
-    # add a suffix, if one was specified
-    if "suffix" in kwargs.keys():
-        suffix = kwargs["suffix"]
-    else:
-        suffix = ""
-
-    # make a file to write the data back out into .dat format
-    outpath = os.path.join(folderpath, "".join(("openephys", suffix, ".dat")))
-    out = open(outpath, "wb")
+        reference = [ref.read]
 
-    # go through the data and write it out in the .dat format
-    # .dat format specified here: http://neuroscope.sourceforge.net/UserManual/data-files.html
-    channelOrder = []
     print("".join(("...saving .dat to ", outpath, "...")))
-    random_datakey = next(iter(data))
-    bar = ProgressBar(len(data[random_datakey]["data"]))
-    for i in range(len(data[random_datakey]["data"])):
-        for j in range(len(order)):
-            if source in random_datakey:
-                ch = data[order[j]]["data"]
-            else:
-                ch = data["".join(("CH", str(order[j]).replace("CH", "")))]["data"]
-            out.write(struct.pack("h", ch[i]))  # signed 16-bit integer
-            # figure out which order this thing packed the channels in. only do this once.
-            if i == 0:
-                channelOrder.append(order[j])
-        # update how mucb we have list
-        if i % (len(data[random_datakey]["data"]) / 100) == 0:
-            bar.animate(i)
-    out.close()
-    print("".join(("order: ", str(channelOrder))))
+    _write_interleaved(readers, n_samples, outpath, reference, max_memory)
+    print("".join(("order: ", str(order))))
     print("".join((".dat saved to ", outpath)))
+    return outpath
+
+
+def pack_chunked(
+    folderpaths,
+    outpath,
+    channels="all",
+    chprefix="CH",
+    dref=None,
+    session="0",
+    source="100",
+    max_memory=PACK_MAX_MEMORY,
+):
+    """Streams .continuous files into an interleaved int16 .dat file in aligned chunks.
+    Only about max_memory bytes of samples are held at once, so arbitrarily long
+    recordings can be packed. If several folders are given, for example the blocks of a
+    recording session, their samples are concatenated in the order given.
+
+    folderpaths: Folder, or list of folders, holding the .continuous files.
+
+    outpath: Path of the .dat file to write.
+
+    channels:  List of channel numbers specifying order in which channels are packed. By default
+               all CH continous files are packed in numerical order.
+
+    dref:  Digital referencing - either supply a channel number or 'ave' to reference to the
+           average of packed channels.
+
+    max_memory: Approximate number of bytes of samples held in memory at once.
+
+    """
+
+    if isinstance(folderpaths, (str, os.PathLike)):
+        folderpaths = [folderpaths]
+
+    if channels == "all":
+        channels = _get_sorted_channels(folderpaths[0], chprefix, session, source)
+
+    readers, n_samples, reference = [], [], []
+    for folderpath in folderpaths:
+        files = [
+            ContinuousFile(os.path.join(folderpath, f), dtype=np.int16)
+            for f in _continuous_filelist(channels, chprefix, session, source)
+        ]
+        if len(set(f.n_samples for f in files)) != 1:
+            raise CurruptDataError(
+                "Continuous files in " + str(folderpath) + " differ in length"
+            )
+        readers.append([f.read for f in files])
+        n_samples.append(files[0].n_samples)
+
+        if dref is not None and dref != "ave":
+            ref_name = _continuous_filelist([dref], chprefix, session, source)[0]
+            reference.append(
+                ContinuousFile(os.path.join(folderpath, ref_name), dtype=np.int16).read
+            )
+
+    if dref == "ave":
+        print("Digital referencing to average of all channels.")
+        reference = "ave"
+    elif dref is not None:
+        print("Digital referencing to channel " + str(dref))
+    else:
+        reference = None
+
+    print("Packing data to file: " + str(outpath))
+    _write_interleaved(readers, n_samples, outpath, reference, max_memory)
+    print("".join(("order: ", str(channels))))
+    return outpath
+
+
+def _write_interleaved(readers, n_samples, outpath, reference, max_memory):
+    """
+    Writes [sample, channel] int16 chunks to outpath
+
+    readers holds, for each segment, one read(start, stop) callable per channel
+    and n_samples the length of each segment. reference is None, "ave" or one
+    read callable per segment.
+    """
+    n_channels = len(readers[0])
+    chunk_samples = max_memory // (n_channels * BYTES_PER_SAMPLE * 2)
+    chunk_samples = max(chunk_samples // SAMPLES_PER_RECORD, 1) * SAMPLES_PER_RECORD
+
+    t0 = time.time()
+    with open(outpath, "wb") as out:
+        for segment, segment_samples in enumerate(n_samples):
+            for start in range(0, segment_samples, chunk_samples):
+                stop = min(start + chunk_samples, segment_samples)
+                chunk = np.empty((stop - start, n_channels), np.int16)
+                for j, read in enumerate(readers[segment]):
+                    chunk[:, j] = read(start, stop)
+                if reference == "ave":
+                    chunk[:] = chunk - np.mean(chunk, 1)[:, np.newaxis]
+                elif reference is not None:
+                    chunk -= reference[segment](start, stop)[:, np.newaxis]
+                chunk.tofile(out)
+
+    elapsed = time.time() - t0
+    megabytes = sum(n_samples) * n_channels * BYTES_PER_SAMPLE / 1e6
+    print(
+        "".join(
+            (
+                "Packed ",
+                str(round(megabytes, 1)),
+                " MB in ",
+                str(round(elapsed, 1)),
+                " sec (",
+                str(round(megabytes / max(elapsed, 1e-9), 1)),
+                " MB/s)",
+            )
+        )
+    )
 
 
 # **********************************************************
@@ -521,6 +844,15 @@ def pack_2(
     data_array.tofile(os.path.join(folderpath, filename))
 
 
+def _continuous_filelist(channels, chprefix="CH", session="0", source="100"):
+    if session == "0":
+        return [source + "_" + chprefix + x + ".continuous" for x in map(str, channels)]
+    return [
+        source + "_" + chprefix + x + "_" + session + ".continuous"
+        for x in map(str, channels)
+    ]
+
+
 def _get_sorted_channels(folderpath, chprefix="CH", session="0", source="100"):
     Files = [
         f
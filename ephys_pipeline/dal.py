@@ -1,22 +1,187 @@
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, MetaData, text
+import sqlalchemy
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.automap import automap_base
+from .logger import logger
+from pathlib import Path
+from threading import Lock
+import hashlib
+import pickle
 import dotenv
 import os
 
+# directory of pickled reflected metadata, overridden by env DAL_CACHE_DIR
+DAL_CACHE_DIR = Path.home().joinpath(".cache", "ephys_pipeline")
+
 
 class DAL_ORM:
-    def __init__(self, engine):
-        self.Base = automap_base()
-        self.Base.prepare(engine, reflect=True)
+    def __init__(self, engine, metadata=None):
+        if metadata is None:
+            self.Base = automap_base()
+            self.Base.prepare(engine, reflect=True)
+        else:
+            self.Base = automap_base(metadata=metadata)
+            self.Base.prepare()
         for class_name in self.Base.classes.keys():
             setattr(self, class_name, self.Base.classes[class_name])
 
 
 class DAL_CORE:
-    def __init__(self, engine):
+    def __init__(self, engine, metadata=None):
         self.engine = engine
-        self.metadata = MetaData()
-        self.metadata.reflect(bind=engine)
+        if metadata is None:
+            metadata = MetaData()
+            metadata.reflect(bind=engine)
+        self.metadata = metadata
         for table_name in self.metadata.tables.keys():
             setattr(self, table_name, self.metadata.tables[table_name])
+
+
+class DAL_Registry:
+    """
+    Process-wide engines, session factories and reflected ORMs
+
+    One engine, with its connection pool, is created per connection string
+    and process, so forked workers never share pooled connections. The
+    schema is reflected once per engine; on MySQL the reflected MetaData is
+    also pickled to DAL_CACHE_DIR under a hash of information_schema, so a
+    new process only reflects again after the schema has changed.
+
+    Pool options are read from the environment: DB_POOL_SIZE,
+    DB_MAX_OVERFLOW, DB_POOL_RECYCLE and DB_POOL_PRE_PING.
+
+    methods:
+        engine
+        sessionmaker
+        orm
+        metadata
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._engines: dict = {}
+        self._sessionmakers: dict = {}
+        self._metadata: dict = {}
+        self._orms: dict = {}
+
+    @staticmethod
+    def pool_options(environment_dict):
+        options: dict = {}
+        for option, key, convert in (
+            ("pool_size", "DB_POOL_SIZE", int),
+            ("max_overflow", "DB_MAX_OVERFLOW", int),
+            ("pool_recycle", "DB_POOL_RECYCLE", int),
+            ("pool_pre_ping", "DB_POOL_PRE_PING", lambda x: x.lower() == "true"),
+        ):
+            if environment_dict.get(key):
+                options[option] = convert(environment_dict[key])
+        return options
+
+    def engine(self, connection_string):
+        key = (connection_string, os.getpid())
+        with self._lock:
+            if key not in self._engines:
+                logger.debug(f"{self}: creating engine")
+                connect_args: dict = {}
+                if connection_string.startswith("mysql+pymysql"):
+                    # lets bulk_insert use LOAD DATA LOCAL INFILE
+                    connect_args["local_infile"] = True
+                self._engines[key] = create_engine(
+                    connection_string,
+                    connect_args=connect_args,
+                    **self.pool_options(os.environ),
+                )
+            return self._engines[key]
+
+    def sessionmaker(self, engine):
+        with self._lock:
+            if engine not in self._sessionmakers:
+                self._sessionmakers[engine] = sessionmaker(bind=engine)
+            return self._sessionmakers[engine]
+
+    def metadata(self, engine):
+        with self._lock:
+            if engine not in self._metadata:
+                self._metadata[engine] = self._load_metadata(engine)
+            return self._metadata[engine]
+
+    def orm(self, engine):
+        metadata = self.metadata(engine)
+        with self._lock:
+            if engine not in self._orms:
+                self._orms[engine] = DAL_ORM(engine, metadata=metadata)
+            return self._orms[engine]
+
+    def _load_metadata(self, engine):
+        """
+        - reflected MetaData of engine's database, from the on-disk cache if
+          the schema hash matches
+        """
+        schema_hash = self._schema_hash(engine)
+        if schema_hash is None:
+            return self._reflect(engine)
+        cache_path = Path(os.environ.get("DAL_CACHE_DIR", DAL_CACHE_DIR)).joinpath(
+            f"metadata_{schema_hash}.pickle"
+        )
+        if cache_path.exists():
+            try:
+                with open(cache_path, "rb") as f:
+                    logger.debug(f"{self}: loading metadata from {cache_path}")
+                    return pickle.load(f)
+            except Exception as e:
+                logger.warning(f"{self}: unreadable metadata cache {cache_path}: {e}")
+        metadata = self._reflect(engine)
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(metadata, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"{self}: could not cache metadata: {e}")
+        return metadata
+
+    def _reflect(self, engine):
+        logger.debug(f"{self}: reflecting {engine.url.database}")
+        metadata = MetaData()
+        metadata.reflect(bind=engine)
+        return metadata
+
+    @staticmethod
+    def _schema_hash(engine):
+        """
+        - hash of the sqlalchemy version and the columns, keys and foreign keys
+          of the database, or None if the dialect is not MySQL
+        """
+        if engine.dialect.name != "mysql":
+            return None
+        with engine.connect() as connection:
+            columns = connection.execute(
+                text(
+                    "SELECT table_name, column_name, column_type, is_nullable, "
+                    "column_key, column_default, extra "
+                    "FROM information_schema.columns WHERE table_schema = DATABASE() "
+                    "ORDER BY table_name, ordinal_position"
+                )
+            ).fetchall()
+            keys = connection.execute(
+                text(
+                    "SELECT table_name, column_name, constraint_name, "
+                    "referenced_table_name, referenced_column_name "
+                    "FROM information_schema.key_column_usage "
+                    "WHERE table_schema = DATABASE() "
+                    "ORDER BY table_name, constraint_name, ordinal_position"
+                )
+            ).fetchall()
+        # pickled metadata is only readable by the version that wrote it
+        schema = repr(
+            [sqlalchemy.__version__, str(engine.url.database)]
+            + [tuple(row) for row in columns + keys]
+        )
+        return hashlib.sha1(schema.encode()).hexdigest()
+
+    def __repr__(self):
+        return "<DAL_Registry>"
+
+
+registry = DAL_Registry()
@@ -12,3 +12,7 @@ class NoNeuronsError(Error):
 
 class CurruptDataError(Error):
     pass
+
+
+class BulkInsertError(Error):
+    pass
@@ -0,0 +1,63 @@
+from .continuous_tools import loadEvents, ContinuousFile
+from .errors import CurruptDataError
+from .logger import logger
+from threading import Lock
+import numpy as np
+
+
+class EventIndex:
+    """
+    Parsed events and first timestamps of the blocks of a recording session
+
+    Each all_channels.events file is parsed once, the first time any signal
+    asks for it, and its timestamps are grouped by (channel, eventId), so
+    every digital signal of the block is a dict lookup. First timestamps of
+    continuous files are read from their first record and cached likewise.
+
+    methods:
+        timestamps
+        first_timestamp
+    """
+
+    def __init__(self):
+        self._events: dict = {}
+        self._first_timestamps: dict = {}
+        self._lock = Lock()
+
+    def timestamps(self, events_path, channel, event_id):
+        """
+        - int64 timestamps, in file order, of the events in events_path with
+          the given channel and eventId
+        """
+        with self._lock:
+            if events_path not in self._events:
+                self._events[events_path] = self._group_events(events_path)
+            groups = self._events[events_path]
+        return groups.get((int(channel), int(event_id)), np.zeros(0, np.int64))
+
+    def first_timestamp(self, continuous_path):
+        with self._lock:
+            if continuous_path not in self._first_timestamps:
+                logger.debug(f"{self}: reading first timestamp of {continuous_path}")
+                self._first_timestamps[continuous_path] = ContinuousFile(
+                    continuous_path
+                ).first_timestamp
+            if self._first_timestamps[continuous_path] is None:
+                raise CurruptDataError(f"No records in {continuous_path}")
+            return self._first_timestamps[continuous_path]
+
+    def _group_events(self, events_path):
+        logger.debug(f"{self}: indexing {events_path}")
+        events = loadEvents(events_path)
+        keys = events["channel"].astype(np.int64) << 8 | events["eventId"]
+        order = np.argsort(keys, kind="stable")
+        group_keys, offsets = np.unique(keys[order], return_index=True)
+        offsets = np.append(offsets, len(order))
+        timestamps = events["timestamps"][order]
+        return {
+            (int(key >> 8), int(key & 0xFF)): timestamps[start:stop]
+            for key, start, stop in zip(group_keys, offsets[:-1], offsets[1:])
+        }
+
+    def __repr__(self):
+        return "<EventIndex>"
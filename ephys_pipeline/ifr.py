@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+
+def ifr_by_neuron(spike_times_s, cluster_ids, ifr_fs=1, t_start=0):
+    """
+    Instantaneous firing rate of every neuron on a shared time grid
+
+    - the rate at each spike after a neuron's first is 1 / the preceding ISI
+    - rates are linearly interpolated onto t_start + i / ifr_fs for each
+      neuron, up to its last spike, holding the first and last rates constant
+      outside of them
+    - all neurons are interpolated in one searchsorted over (neuron, time)
+      sorted arrays rather than neuron by neuron
+    - neurons with fewer than two spikes have no rate and are dropped
+
+    params:
+        spike_times_s: array of spike times in seconds
+        cluster_ids: array of the cluster id of each spike
+        ifr_fs: sampling rate of the returned ifr
+        t_start: time of the first grid point
+    returns:
+        pandas df with cols timepoint_s, ifr (float32), cluster_id
+    """
+    spike_times_s = np.asarray(spike_times_s, dtype=np.float64)
+    cluster_ids = np.asarray(cluster_ids)
+    order = np.lexsort((spike_times_s, cluster_ids))
+    spike_times_s, cluster_ids = spike_times_s[order], cluster_ids[order]
+
+    neurons, starts, counts = np.unique(
+        cluster_ids, return_index=True, return_counts=True
+    )
+    # rate points: every spike but the first of each neuron
+    rate_points = np.ones(len(spike_times_s), dtype=bool)
+    rate_points[starts] = False
+    x = spike_times_s[rate_points]
+    y = 1 / (x - spike_times_s[np.flatnonzero(rate_points) - 1])
+
+    keep = counts > 1
+    neurons, starts, counts = neurons[keep], starts[keep], counts[keep]
+    if len(neurons) == 0:
+        return pd.DataFrame(
+            {
+                "timepoint_s": np.zeros(0),
+                "ifr": np.zeros(0, np.float32),
+                "cluster_id": np.zeros(0, cluster_ids.dtype),
+            }
+        )
+
+    neuron_index = np.repeat(np.arange(len(neurons)), counts - 1)
+    x_starts = np.append(0, np.cumsum(counts - 1))
+
+    # grid points of each neuron, up to its last spike
+    t_last = spike_times_s[starts + counts - 1]
+    n_grid = np.maximum(np.ceil((t_last - t_start) * ifr_fs).astype(np.int64), 0)
+    grid_neuron = np.repeat(np.arange(len(neurons)), n_grid)
+    grid_offsets = np.append(0, np.cumsum(n_grid))
+    grid = t_start + (np.arange(grid_offsets[-1]) - grid_offsets[grid_neuron]) / ifr_fs
+
+    # offset each neuron's times past the last so one searchsorted covers all
+    span = max(np.abs(x).max(), np.abs(grid).max(initial=0)) + 1
+    position = np.searchsorted(
+        neuron_index * span + x, grid_neuron * span + grid, side="right"
+    )
+    first, last = x_starts[grid_neuron], x_starts[grid_neuron + 1] - 1
+    hi = np.clip(position, first, last)
+    lo = np.clip(position - 1, first, last)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(hi == lo, 0, (grid - x[lo]) / (x[hi] - x[lo]))
+    ifr = y[lo] + weight * (y[hi] - y[lo])
+
+    return pd.DataFrame(
+        {
+            "timepoint_s": grid,
+            "ifr": ifr.astype(np.float32),
+            "cluster_id": neurons[grid_neuron],
+        }
+    )
@@ -1,6 +1,9 @@
 from .utils import _prep_db
 from .errors import DuplicateError
 from .logger import logger
+from .spectrogram import Spectrogram
+from .reference_cache import reference_cache
+from .bulk import bulk_insert
 import pandas as pd
 import numpy as np
 import dotenv
@@ -14,11 +17,19 @@ class Inserter:
     - Base class for inserters
     - Has a list attribute which stores insert methods
     - Has a run_inserts method which runs each insert method sequentially in
-      a single database transaction
+      a single database transaction, returning False if it was skipped as a
+      duplicate
+    - Files appended to intermediate_files by insert methods are removed only
+      once the transaction has been commited
+    - Inserters of reference data set invalidates_references so that the
+      reference cache is reloaded once they have commited
     """
 
+    invalidates_references = False
+
     def __init__(self):
         self.insert_methods: list = []
+        self.intermediate_files: list = []
 
     def _duplicate_check(self):
         raise NotImplementedError
@@ -37,10 +48,12 @@ class Inserter:
             if self.duplicates == "skip":
                 logger.debug("rolling back transaction")
                 session.rollback()
-                return
+                session.close()
+                return False
             elif self.duplicates == "fail":
                 logger.debug("rolling back transaction")
                 session.rollback()
+                session.close()
                 raise
             elif self.duplicates == "overwrite":
                 self._overwrite(session=session)
@@ -56,9 +69,19 @@ class Inserter:
         else:
             logger.debug("commiting transaction")
             session.commit()
+            if self.invalidates_references:
+                reference_cache.invalidate()
+            self._remove_intermediate_files()
         finally:
             logger.debug("closing transaction")
             session.close()
+        return True
+
+    def _remove_intermediate_files(self):
+        for path in self.intermediate_files:
+            if os.path.exists(path):
+                os.remove(path)
+        self.intermediate_files = []
 
 
 class ChanMapInserter(Inserter):
@@ -66,6 +89,8 @@ class ChanMapInserter(Inserter):
     - Inserts a chan map and its channel mappings to the db
     """
 
+    invalidates_references = True
+
     def __init__(self, meta, chan_map, shank, duplicates):
         self.meta = meta
         self.chan_map = chan_map
@@ -122,6 +147,8 @@ class ExperimentInserter(Inserter):
     - inserts an experiment, experimental groups and blocks into the db
     """
 
+    invalidates_references = True
+
     def __init__(
         self,
         meta: dict,
@@ -207,6 +234,8 @@ class AnalogSignalInserter(Inserter):
     - Inserts an analog signal into the db
     """
 
+    invalidates_references = True
+
     def __init__(self, signal_type, recording_location, signal_name, duplicates):
         self.signal_type = signal_type
         self.recording_location = recording_location
@@ -248,6 +277,8 @@ class DiscreteSignalInserter(Inserter):
     - Inserts a discrete signal into the db
     """
 
+    invalidates_references = True
+
     def __init__(self, duplicates, signal_name: str, description=None):
         self.signal_name = signal_name
         self.description = description
@@ -288,7 +319,9 @@ class RecordingSessionInserter(Inserter):
 
     def __init__(self, recording):
         self.recording = recording
+        self.duplicates = recording.duplicates
         super().__init__()
+        self.intermediate_files.append(recording.checkpoints.path)
         self.insert_methods.append(self.insert_recording_session)
         self.insert_methods.append(self.insert_session_block_times)
         self.insert_methods.append(self.insert_recording_session_config)
@@ -303,10 +336,12 @@ class RecordingSessionInserter(Inserter):
         self.insert_methods.append(self.insert_waveforms)
 
     def _duplicate_check(self, session):
-        pass
+        # re-checked here as another process may have inserted the session
+        # while it was being processed
+        self.recording._duplicate_check(session=session)
 
     def _overwrite(self, session):
-        pass
+        self.recording._overwrite(session=session)
 
     def insert_recording_session(self, session):
         logger.info(f"{self}: Inserting recording session")
@@ -351,11 +386,8 @@ class RecordingSessionInserter(Inserter):
         for signal in self.recording.analog_signals:
             if signal.is_corrupt:
                 continue
-            signal_id = (
-                session.query(self.orm.analog_signals)
-                .filter(self.orm.analog_signals.signal_name == signal.signal_name)
-                .one()
-                .id
+            signal_id = reference_cache.analog_signal_id(
+                session, self.orm, signal.signal_name
             )
             new_signal = self.orm.session_analog_signals(
                 recording_session_id=self.db_recording.id, signal_id=signal_id
@@ -373,11 +405,8 @@ class RecordingSessionInserter(Inserter):
         for signal in self.recording.discrete_signals:
             if signal.is_corrupt:
                 continue
-            signal_id = (
-                session.query(self.orm.discrete_signals)
-                .filter(self.orm.discrete_signals.signal_name == signal.signal_name)
-                .one()
-                .id
+            signal_id = reference_cache.discrete_signal_id(
+                session, self.orm, signal.signal_name
             )
             new_signal = self.orm.session_discrete_signals(
                 recording_session_id=self.db_recording.id, discrete_signal_id=signal_id
@@ -398,10 +427,8 @@ class RecordingSessionInserter(Inserter):
                 signal.processed_data["downsampled_data"]
             )
             downsampled_data["signal_id"] = signal.id
-            session.bulk_insert_mappings(
-                self.orm.analog_data, downsampled_data.to_dict(orient="records")
-            )
-            os.remove(signal.processed_data["downsampled_data"])
+            bulk_insert(session, self.orm.analog_data, downsampled_data)
+            self.intermediate_files.append(signal.processed_data["downsampled_data"])
 
     def insert_analog_signal_fft(self, session):
         if not self.recording.analog_signals:
@@ -411,12 +438,12 @@ class RecordingSessionInserter(Inserter):
         for signal in self.recording.analog_signals:
             if signal.is_corrupt:
                 continue
-            stft_data = pd.read_feather(signal.processed_data["stft_data"])
+            stft_data = Spectrogram.load(signal.processed_data["stft_data"]).to_tidy()
             stft_data["signal_id"] = signal.id
-            session.bulk_insert_mappings(
-                self.orm.analog_signal_stft, stft_data.to_dict(orient="records")
+            bulk_insert(session, self.orm.analog_signal_stft, stft_data)
+            self.intermediate_files.extend(
+                Spectrogram.paths(signal.processed_data["stft_data"]).values()
             )
-            os.remove(signal.processed_data["stft_data"])
 
     def insert_discrete_signal_data(self, session):
         if not self.recording.discrete_signals:
@@ -426,12 +453,15 @@ class RecordingSessionInserter(Inserter):
         for signal in self.recording.discrete_signals:
             if signal.is_corrupt:
                 continue
-            data = np.load(signal.processed_data["data_path"])
+            data = signal.processed_data.get("data")
+            if data is None:
+                data = np.load(signal.processed_data["data_path"])
             data = pd.DataFrame({"signal_id": signal.id, "timepoint_sample": data})
             session.bulk_insert_mappings(
                 self.orm.discrete_signal_data, data.to_dict(orient="records")
             )
-            os.remove(signal.processed_data["data_path"])
+            if signal.processed_data.get("data_path") is not None:
+                self.intermediate_files.append(signal.processed_data["data_path"])
 
     def insert_neurons(self, session):
         if self.recording.no_neurons:
@@ -450,7 +480,7 @@ class RecordingSessionInserter(Inserter):
             )
             session.add(new_neuron)
             session.flush()
-        os.remove(fname)
+        self.intermediate_files.append(fname)
         self.db_neurons = pd.DataFrame(
             [
                 {"neuron_id": n.id, "cluster_id": n.cluster_id}
@@ -472,10 +502,8 @@ class RecordingSessionInserter(Inserter):
             .drop("cluster_id", axis=1)
             .drop_duplicates()
         )
-        session.bulk_insert_mappings(
-            self.orm.neuron_ifr, ifr.drop_duplicates().to_dict(orient="records"),
-        )
-        os.remove(fname)
+        bulk_insert(session, self.orm.neuron_ifr, ifr)
+        self.intermediate_files.append(fname)
 
     def insert_spike_times(self, session):
         if self.recording.no_neurons:
@@ -489,11 +517,8 @@ class RecordingSessionInserter(Inserter):
             .drop("cluster_id", axis=1)
             .drop_duplicates()
         )
-        session.bulk_insert_mappings(
-            self.orm.spike_times,
-            spike_times.drop_duplicates().to_dict(orient="records"),
-        )
-        os.remove(fname)
+        bulk_insert(session, self.orm.spike_times, spike_times)
+        self.intermediate_files.append(fname)
 
     def insert_waveforms(self, session):
         if self.recording.no_neurons:
@@ -507,10 +532,8 @@ class RecordingSessionInserter(Inserter):
             .drop("cluster_id", axis=1)
             .drop_duplicates()
         )
-        session.bulk_insert_mappings(
-            self.orm.waveforms, waveforms.to_dict(orient="records")
-        )
-        os.remove(fname)
+        bulk_insert(session, self.orm.waveforms, waveforms)
+        self.intermediate_files.append(fname)
 
     def __repr__(self):
         return f"<RecordingInserter: {self.recording.meta['session_name']}>"
@@ -0,0 +1,151 @@
+from .logger import logger
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# bits of a packed (cluster, time) key holding the spike time
+TIME_BITS = 40
+
+
+class KilosortDir:
+    """
+    Lazily loaded view of a Kilosort output directory
+
+    Each .npy output is memory-mapped the first time it is used and cached,
+    as is an index of spikes grouped by cluster, so the spike stages of a
+    session share one view of the directory instead of each reloading it.
+
+    methods:
+        load
+        joinpath
+        select
+        get_spiketimes
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._arrays: dict = {}
+        self._cluster_index = None
+        self._cluster_groups = None
+
+    def joinpath(self, *args):
+        return self.path.joinpath(*args)
+
+    def load(self, name):
+        """
+        - memory-maps <name>.npy on first use and returns the cached array
+        - column vectors such as spike_times.npy are flattened
+        """
+        if name not in self._arrays:
+            fname = self.path.joinpath(name + ".npy")
+            logger.debug(f"{self}: loading {fname}")
+            array = np.load(fname, mmap_mode="r")
+            if array.ndim == 2 and array.shape[1] == 1:
+                array = array.reshape(-1)
+            self._arrays[name] = array
+        return self._arrays[name]
+
+    @property
+    def spike_times(self):
+        return self.load("spike_times")
+
+    @property
+    def spike_clusters(self):
+        return self.load("spike_clusters")
+
+    @property
+    def spike_templates(self):
+        return self.load("spike_templates")
+
+    @property
+    def amplitudes(self):
+        return self.load("amplitudes")
+
+    @property
+    def templates(self):
+        return self.load("templates")
+
+    @property
+    def whitening_mat_inv(self):
+        return self.load("whitening_mat_inv")
+
+    @property
+    def channel_map(self):
+        if not self.path.joinpath("channel_map.npy").exists():
+            return None
+        return self.load("channel_map")
+
+    @property
+    def cluster_groups(self):
+        if self._cluster_groups is None:
+            fn = self.path.joinpath("cluster_groups.csv")
+            logger.debug(f"{self}: loading {fn}")
+            self._cluster_groups = pd.read_csv(fn, sep="\t")
+        return self._cluster_groups.copy()
+
+    @property
+    def cluster_index(self):
+        """
+        - (cluster_ids, order, offsets): the spikes of cluster_ids[i] are
+          order[offsets[i]:offsets[i + 1]], in file order
+        """
+        if self._cluster_index is None:
+            order = np.argsort(self.spike_clusters, kind="stable")
+            cluster_ids, offsets = np.unique(
+                self.spike_clusters[order], return_index=True
+            )
+            offsets = np.append(offsets, len(order))
+            self._cluster_index = (cluster_ids, order, offsets)
+        return self._cluster_index
+
+    def select(self, cluster_ids):
+        """
+        - indices of the spikes of cluster_ids, grouped by cluster in the
+          order given, and the position in cluster_ids of each spike's cluster
+        """
+        all_ids, order, offsets = self.cluster_index
+        positions = np.searchsorted(all_ids, cluster_ids)
+        found = (positions < len(all_ids)) & (
+            all_ids[np.minimum(positions, len(all_ids) - 1)] == cluster_ids
+        )
+        starts, stops = offsets[positions[found]], offsets[positions[found] + 1]
+        indices = np.concatenate(
+            [order[start:stop] for start, stop in zip(starts, stops)]
+            or [np.zeros(0, np.int64)]
+        )
+        cluster_index = np.repeat(np.flatnonzero(found), stops - starts)
+        return indices, cluster_index
+
+    def get_spiketimes(self, cluster_ids):
+        """
+        - df with cols spike_time_samples, cluster_id of the unique spikes
+          of cluster_ids, sorted by cluster then time
+        - duplicates are dropped with a sorted unique over packed
+          (cluster, time) keys
+        """
+        cluster_ids = np.unique(np.asarray(cluster_ids))
+        indices, cluster_index = self.select(cluster_ids)
+        keys = np.unique(
+            (cluster_index.astype(np.int64) << TIME_BITS)
+            | self.spike_times[indices].astype(np.int64)
+        )
+        return pd.DataFrame(
+            {
+                "spike_time_samples": (keys & ((1 << TIME_BITS) - 1)).astype(
+                    self.spike_times.dtype
+                ),
+                "cluster_id": cluster_ids[keys >> TIME_BITS].astype(
+                    self.spike_clusters.dtype
+                ),
+            }
+        )
+
+    def __repr__(self):
+        return f"<KilosortDir: {self.path}>"
+
+
+def as_kilosort_dir(kilosort_dir):
+    """Returns kilosort_dir as a KilosortDir, wrapping it if it is a path"""
+    if isinstance(kilosort_dir, KilosortDir):
+        return kilosort_dir
+    return KilosortDir(kilosort_dir)
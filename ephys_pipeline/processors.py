@@ -1,40 +1,64 @@
 from .logger import logger
-from .errors import NoNeuronsError
-from .utils import make_filename
+from .errors import NoNeuronsError, CurruptDataError
 from .utils import get_waveforms as waveforms_functional
-from spiketimes.df import ifr_by_neuron
-from scipy.signal import decimate, stft
+from .utils import get_template_waveforms
+from .spectrogram import Spectrogram
+from .kilosort import as_kilosort_dir
+from .ifr import ifr_by_neuron
+from scipy.signal import firwin, upfirdn, stft
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from collections import deque
 import pandas as pd
 import numpy as np
-import os
+
+# number of input samples decimated at a time
+DECIMATION_CHUNK_SIZE = 2 ** 20
+# number of samples scanned for threshold crossings at a time
+DETECTION_CHUNK_SIZE = 2 ** 20
 
 
 class BlockTimesProcessor:
     def __init__(self):
         pass
 
-    def get_block_lengths(self, continuous_blocks, blocks):
+    def get_block_lengths(self, continuous_blocks, blocks, salvage=False):
+        """
+        - returns a dict for each block with data with keys: {"block_name",
+          "block_start", "block_length", "first_timestamp", "last_timestamp",
+          "sampling_rate"}
+        - lengths are derived from the file size of CH3 and timestamps from
+          its first and last records, so no samples are decoded
+        - a header-only CH3 gives a block_length of 0 and None timestamps
+        - with salvage, timestamps come from the first and last good records
+        """
+        continuous_blocks = {
+            continuous_block.block_name: continuous_block
+            for continuous_block in continuous_blocks
+        }
         block_lengths: list = []
         total_time: int = 0
         for block in blocks:
             logger.debug(f"Processing {block}")
-            try:
-                continuous_block = next(
-                    filter(lambda x: x.block_name == block, continuous_blocks)
-                )
-                logger.debug(f"{self}.get_block_lengths: {continuous_block}")
-            except StopIteration:
+            continuous_block = continuous_blocks.get(block)
+            if continuous_block is None:
                 logger.debug(
                     f"{self}.get_block_lengths: No data availible for block {block}"
                 )
                 continue
-            data = continuous_block.load_continuous_channel()
-            block_length = len(data)
+            logger.debug(f"{self}.get_block_lengths: {continuous_block}")
+            continuous_file = continuous_block.open_continuous_channel(
+                salvage=salvage
+            )
+            block_length = continuous_file.n_samples
             block_lengths.append(
                 {
                     "block_length": block_length,
                     "block_name": continuous_block.block_name,
                     "block_start": total_time,
+                    "first_timestamp": continuous_file.first_timestamp,
+                    "last_timestamp": continuous_file.last_timestamp,
+                    "sampling_rate": continuous_file.sampling_rate,
                 }
             )
             total_time += block_length
@@ -49,88 +73,350 @@ class DiscreteSignalProcessor:
         pass
 
     def process_events(
-        self, blocks: list, discrete_signal, block_lengths, tmp_dir,
+        self,
+        blocks: list,
+        discrete_signal,
+        block_lengths,
+        n_workers=1,
+        max_memory=None,
+        spill_path=None,
     ):
         """
+        - loads the events of each block, with at most n_workers blocks in
+          flight, and returns them concatenated in block order
+        - results are kept in memory unless they exceed max_memory bytes, in
+          which case they are written to spill_path and returned as a memmap
         """
-        tmp_files: list = []
         if discrete_signal.from_manual:
             return discrete_signal.load()
+        block_lengths = {
+            block_length["block_name"]: block_length for block_length in block_lengths
+        }
+        block_starts: list = []
         for block in blocks:
-            logger.debug(f"{self}.process_events: Processing {block}")
-            try:
-                block_length = next(
-                    filter(lambda x: x["block_name"] == block, block_lengths)
-                )
-            except StopIteration:
+            if block not in block_lengths:
                 logger.debug(f"No data availible for block: {block}")
                 continue
-            signal_data = discrete_signal.load(
-                block_name=block, block_start=block_length["block_start"]
-            )
-            tmp_fname = tmp_dir.joinpath(
-                make_filename(discrete_signal.signal_name, block, ext=".npy")
-            )
-            np.save(tmp_fname, signal_data)
-            tmp_files.append(tmp_fname)
+            block_starts.append((block, block_lengths[block]["block_start"]))
 
-        output = np.concatenate([np.load(file) for file in tmp_files])
-        for file in tmp_files:
-            os.remove(file)
-        return output
+        def load_block(block_start):
+            block, start = block_start
+            logger.debug(f"{self}.process_events: Processing {block}")
+            return discrete_signal.load(block_name=block, block_start=start)
+
+        def load_blocks(executor):
+            # at most n_workers blocks are loaded ahead of _concatenate, so
+            # max_memory also bounds the blocks waiting to be spilled
+            in_flight = deque()
+            for block_start in block_starts:
+                if len(in_flight) >= n_workers:
+                    yield in_flight.popleft().result()
+                in_flight.append(executor.submit(load_block, block_start))
+            while in_flight:
+                yield in_flight.popleft().result()
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return self._concatenate(load_blocks(executor), max_memory, spill_path)
+
+    def _concatenate(self, parts, max_memory=None, spill_path=None):
+        """
+        - concatenates parts in memory, or appends them to spill_path once
+          they exceed max_memory bytes
+        """
+        in_memory: list = []
+        n_bytes = 0
+        spill_file = None
+        try:
+            for part in parts:
+                n_bytes += part.nbytes
+                in_memory.append(part)
+                if spill_file is None and (
+                    max_memory is None or spill_path is None or n_bytes <= max_memory
+                ):
+                    continue
+                if spill_file is None:
+                    logger.debug(f"{self}: spilling events to {spill_path}")
+                    spill_file = open(spill_path, "wb")
+                for spilled in in_memory:
+                    spilled.astype(int).tofile(spill_file)
+                in_memory = []
+        finally:
+            if spill_file is not None:
+                spill_file.close()
+        if spill_file is not None:
+            return np.memmap(spill_path, dtype=int, mode="r")
+        if not in_memory:
+            return np.zeros(0, dtype=int)
+        return np.concatenate(in_memory)
 
     def __repr__(self):
         return "<DiscreteSignalProcessor>"
 
 
+@lru_cache(maxsize=None)
+def decimation_filter(q: int):
+    """
+    - FIR filter used by scipy.signal.decimate(x, q, ftype="fir")
+    - the design depends only on q so is shared by every signal decimated by q
+    """
+    h = firwin(20 * q + 1, 1.0 / q, window="hamming")
+    h.flags.writeable = False
+    return h
+
+
+class StreamingDecimator:
+    """
+    Zero-phase FIR decimation of a signal read a chunk at a time
+
+    Gives the same output as scipy.signal.decimate(x, q, ftype="fir") while
+    only holding one chunk, plus the filter overlap at its edges, in memory.
+    Each chunk of outputs is computed with upfirdn from the input samples
+    under the filter, zero padded beyond the ends of the signal.
+
+    params:
+        q: downsampling factor
+        chunk_size: approximate number of input samples read at a time
+    """
+
+    def __init__(self, q: int, chunk_size: int = DECIMATION_CHUNK_SIZE):
+        self.q = q
+        self.chunk_size = chunk_size
+        self.h = decimation_filter(q)
+        self.half_len = (len(self.h) - 1) // 2
+        # leading outputs of each chunk which only see its overlap
+        self.n_lead = -(-(len(self.h) - 1) // q)
+
+    def output_length(self, n_samples: int):
+        return n_samples // self.q + bool(n_samples % self.q)
+
+    def decimate(self, read, n_samples: int, out=None):
+        """
+        - read(start, stop) returns input samples [start, stop) as a 1-D or
+          [sample, channel] array
+        - writes the decimated signal to out, or a new array, and returns it
+        """
+        n_out = self.output_length(n_samples)
+        outputs_per_chunk = max(self.chunk_size // self.q, 1)
+        for out_start in range(0, n_out, outputs_per_chunk):
+            out_stop = min(out_start + outputs_per_chunk, n_out)
+            start = out_start * self.q + self.half_len - self.n_lead * self.q
+            stop = (out_stop - 1) * self.q + self.half_len + 1
+            chunk = self._read_padded(read, start, stop, n_samples)
+            decimated = upfirdn(self.h, chunk, up=1, down=self.q, axis=0)
+            if out is None:
+                out = np.empty((n_out,) + decimated.shape[1:])
+            out[out_start:out_stop] = decimated[
+                self.n_lead : self.n_lead + out_stop - out_start
+            ]
+        return out
+
+    @staticmethod
+    def _read_padded(read, start, stop, n_samples):
+        """samples [start, stop) with zeros outside [0, n_samples)"""
+        lo, hi = max(start, 0), min(stop, n_samples)
+        samples = np.asarray(read(lo, hi), dtype=np.float64)
+        if lo == start and hi == stop:
+            return samples
+        padded = np.zeros((stop - start,) + samples.shape[1:])
+        padded[lo - start : hi - start] = samples
+        return padded
+
+    def __repr__(self):
+        return f"<StreamingDecimator: q={self.q}>"
+
+
+class ThresholdDetector:
+    """
+    Onsets of the pulses of a signal read a chunk at a time
+
+    A threshold crossing is a sample i where x[i + 1] - x[i] > threshold. A
+    crossing only starts a new pulse if the previous crossing was more than
+    refractory samples earlier, so a run of consecutive crossings gives one
+    onset, as does a rising edge which rings for up to refractory samples. The last sample and crossing of each chunk are
+    carried over, so chunking does not change the result.
+
+    params:
+        threshold: minimum sample to sample rise of an onset
+        refractory: number of samples after a crossing in which further
+                    crossings belong to the same pulse
+        chunk_size: number of samples read at a time
+    """
+
+    def __init__(
+        self, threshold, refractory: int = 1, chunk_size: int = DETECTION_CHUNK_SIZE
+    ):
+        self.threshold = threshold
+        self.refractory = max(refractory, 1)
+        self.chunk_size = chunk_size
+
+    def detect(self, read, n_samples: int):
+        """
+        - read(start, stop) returns samples [start, stop) of a 1-D signal
+        - returns the sample indices of the pulse onsets
+        """
+        onsets: list = []
+        last_sample = None
+        last_crossing = -np.inf
+        for start in range(0, n_samples, self.chunk_size):
+            chunk = np.asarray(read(start, min(start + self.chunk_size, n_samples)))
+            if last_sample is not None:
+                chunk = np.concatenate(([last_sample], chunk))
+                start -= 1
+            last_sample = chunk[-1]
+            crossings = start + np.flatnonzero(np.diff(chunk) > self.threshold)
+            if len(crossings) == 0:
+                continue
+            gaps = np.diff(crossings, prepend=last_crossing)
+            onsets.append(crossings[gaps > self.refractory])
+            last_crossing = crossings[-1]
+        return np.concatenate(onsets) if onsets else np.zeros(0, dtype=np.int64)
+
+    def __repr__(self):
+        return f"<ThresholdDetector: threshold={self.threshold}>"
+
+
 class AnalogSignalProcessor:
     def __init__(self):
         pass
 
-    def downsample(self, blocks, asignal, tmp_dir):
+    def downsample(self, blocks, asignal, chunk_size=DECIMATION_CHUNK_SIZE):
+        """
+        - decimates each block of asignal to its desired sampling rate and
+          concatenates them into an array preallocated from the file sizes
+        - blocks are streamed through StreamingDecimator in chunks of
+          chunk_size samples so peak memory does not grow with block length
+        - returns a tidy df with columns timepoint_s, voltage
+        """
         downsampling_factor = int(
             asignal.current_sampling_rate / asignal.desired_sampling_rate
         )
-        sampling_period = 1 / asignal.desired_sampling_rate
-        tmp_files: list = []
+        decimator = StreamingDecimator(q=downsampling_factor, chunk_size=chunk_size)
+        continuous_files: dict = {}
         for block in blocks:
-            logger.debug(f"{self}.downsample: Processing: {block}")
+            logger.debug(f"{self}.downsample: Opening: {block}")
             try:
-                signal_data = asignal.load(block=block)
+                continuous_files[block] = asignal.open(block=block)
             except KeyError:
                 logger.debug(f"{self}.downsample: Data unavailible for {block}")
                 continue
-            downsampled_data = decimate(signal_data, q=downsampling_factor, ftype="fir")
-            tmp_fname = tmp_dir.joinpath(
-                make_filename(asignal.signal_name, block, ext=".npy")
+
+        block_lengths = [
+            decimator.output_length(continuous_file.n_samples)
+            for continuous_file in continuous_files.values()
+        ]
+        data = np.empty(sum(block_lengths))
+        block_start = 0
+        for (block, continuous_file), block_length in zip(
+            continuous_files.items(), block_lengths
+        ):
+            logger.debug(f"{self}.downsample: Processing: {block}")
+            decimator.decimate(
+                continuous_file.read,
+                continuous_file.n_samples,
+                out=data[block_start : block_start + block_length],
             )
-            np.save(tmp_fname, downsampled_data)
-            tmp_files.append(tmp_fname)
-        logger.debug(f"{self}: downsample: Concatenating")
-        data = np.concatenate([np.load(file) for file in tmp_files])
-        time = np.cumsum(np.ones((1, len(data))).flatten() * sampling_period)
-        output = pd.DataFrame({"timepoint_s": time, "voltage": data})
-        for file in tmp_files:
-            os.remove(file)
+            if asignal.salvage:
+                asignal.record_integrity(block, continuous_file.integrity())
+            block_start += block_length
+
+        time = np.arange(1, len(data) + 1) / asignal.desired_sampling_rate
+        return pd.DataFrame({"timepoint_s": time, "voltage": data})
+
+    def downsample_batch(
+        self, blocks, asignals, n_workers=None, chunk_size=DECIMATION_CHUNK_SIZE
+    ):
+        """
+        - decimates several analog signals together, one block at a time
+        - signals are grouped by sampling rates; for each group and block the
+          chunks of every channel are read concurrently into one
+          [sample, signal] array which is decimated along axis 0
+        - returns a dict of signal_name: df with columns timepoint_s, voltage,
+          matching the output of downsample
+        """
+        groups: dict = {}
+        for asignal in asignals:
+            rates = (asignal.current_sampling_rate, asignal.desired_sampling_rate)
+            groups.setdefault(rates, []).append(asignal)
+
+        output: dict = {}
+        for (current_rate, desired_rate), group in groups.items():
+            logger.debug(f"{self}.downsample_batch: Processing: {group}")
+            decimator = StreamingDecimator(
+                q=int(current_rate / desired_rate), chunk_size=chunk_size
+            )
+            continuous_files: dict = {}
+            for block in blocks:
+                try:
+                    continuous_files[block] = [
+                        asignal.open(block=block) for asignal in group
+                    ]
+                except KeyError:
+                    logger.debug(
+                        f"{self}.downsample_batch: Data unavailible for {block}"
+                    )
+                    continue
+                if len(set(f.n_samples for f in continuous_files[block])) != 1:
+                    raise CurruptDataError(f"Signals differ in length in {block}")
+
+            block_lengths = [
+                decimator.output_length(files[0].n_samples)
+                for files in continuous_files.values()
+            ]
+            data = np.empty((sum(block_lengths), len(group)))
+            block_start = 0
+            with ThreadPoolExecutor(max_workers=n_workers or len(group)) as executor:
+                for (block, files), block_length in zip(
+                    continuous_files.items(), block_lengths
+                ):
+                    logger.debug(f"{self}.downsample_batch: Processing: {block}")
+                    decimator.decimate(
+                        partial(self._read_columns, files=files, executor=executor),
+                        files[0].n_samples,
+                        out=data[block_start : block_start + block_length],
+                    )
+                    for asignal, continuous_file in zip(group, files):
+                        if asignal.salvage:
+                            asignal.record_integrity(block, continuous_file.integrity())
+                    block_start += block_length
+
+            time = np.arange(1, len(data) + 1) / desired_rate
+            for i, asignal in enumerate(group):
+                output[asignal.signal_name] = pd.DataFrame(
+                    {"timepoint_s": time, "voltage": data[:, i].copy()}
+                )
         return output
 
-    def stft(self, signal, fs: int, fft_window: int):
+    @staticmethod
+    def _read_columns(start, stop, files, executor):
+        """samples [start, stop) of each file decoded concurrently into columns"""
+        columns = np.empty((stop - start, len(files)))
+        list(
+            executor.map(
+                lambda i: files[i].read(start, stop, out=columns[:, i]),
+                range(len(files)),
+            )
+        )
+        return columns
+
+    def stft(self, signal, fs: int, fft_window: int, compact=False, max_frequency=None):
         """
         - takes input signal of tidy df
         - performs stft on the signal
         - returns a tidy dataframe result with columns time, f, value
         - fft window: time in seconds for the stft
         - t is returned in units of seconds
+        - if compact, returns a float32 Spectrogram instead of the tidy df
+        - max_frequency: optional upper limit on the frequencies kept
         """
         logger.debug(f"{self}: stft: running function")
         nperseg = fft_window * fs
         f, t, Zxx = stft(signal, fs=fs, nperseg=nperseg)
-        df2 = pd.DataFrame(data=np.abs(Zxx), index=f, columns=t)
-        return (
-            df2.reset_index()
-            .rename(columns={"index": "frequency"})
-            .melt(id_vars="frequency", var_name="timepoint_s", value_name="fft_value")
-        )
+        spectrogram = Spectrogram(
+            frequency=f, timepoint_s=t, fft_value=np.abs(Zxx)
+        ).band(max_frequency)
+        if compact:
+            return spectrogram
+        return spectrogram.to_tidy(dropna=False)
 
     def __repr__(self):
         return f"<AnalogSignalProcessor>"
@@ -145,10 +431,9 @@ class SpikesProcessor:
         - given kilosort dir, create pandas df with columns recording_session_name, cluster_id, is_single_unit
         - is_single_unit = True for SU, Flase for MUA
         - discards noise clusters
+        - kilosort_dir may be a path or a shared KilosortDir
         """
-        fn = kilosort_dir.joinpath("cluster_groups.csv")
-        logger.debug(f"{self}: loading {fn}")
-        neurons = pd.read_csv(fn, sep="\t")
+        neurons = as_kilosort_dir(kilosort_dir).cluster_groups
         neurons = neurons.loc[neurons["group"] != "noise"]
         if len(neurons) == 0:
             raise NoNeuronsError("No neurons found")
@@ -156,33 +441,47 @@ class SpikesProcessor:
         return neurons.drop("group", axis=1)
 
     def get_spiketimes(self, kilosort_dir, neurons):
-        fn_spike_times = kilosort_dir.joinpath("spike_times.npy")
-        fn_spike_clusters = kilosort_dir.joinpath("spike_clusters.npy")
-        spike_times = np.load(fn_spike_times).flatten()
-        spike_clusters = np.load(fn_spike_clusters).flatten()
-        spike_times = pd.DataFrame(
-            {"spike_time_samples": spike_times, "cluster_id": spike_clusters}
+        """
+        - unique spike times of the neurons, as a df with columns
+          spike_time_samples, cluster_id sorted by cluster then time
+        """
+        kilosort_dir = as_kilosort_dir(kilosort_dir)
+        return kilosort_dir.get_spiketimes(neurons["cluster_id"].values)
+
+    def get_waveforms_chans(
+        self, spike_times, dat_file_path, n_workers=1, max_worker_memory=None
+    ):
+        """
+        - mean waveform and best channel of each cluster from the raw .dat
+        - n_workers > 1 shares the clusters between worker processes, each
+          holding at most max_worker_memory bytes of spike windows
+        """
+        waveforms, chans = waveforms_functional(
+            spike_times,
+            dat_file_path,
+            n_workers=n_workers,
+            max_worker_memory=max_worker_memory,
         )
-        spike_times = spike_times[spike_times["cluster_id"].isin(neurons["cluster_id"])]
-        return spike_times.drop_duplicates()
+        return waveforms, chans
 
-    def get_waveforms_chans(self, spike_times, dat_file_path):
-        waveforms, chans = waveforms_functional(spike_times, dat_file_path)
+    def get_waveforms_chans_from_templates(self, spike_times, kilosort_dir):
+        """
+        - mean waveform and peak channel of each cluster derived from
+          Kilosort's templates.npy, spike_templates.npy, amplitudes.npy and
+          whitening_mat_inv.npy, so the raw .dat is never read
+        """
+        waveforms, chans = get_template_waveforms(spike_times, kilosort_dir)
         return waveforms, chans
 
     def get_ifr(self, spike_times, ifr_fs=1, fs=30000):
-        return (
-            spike_times.assign(
-                spike_times_seconds=spike_times["spike_time_samples"].divide(30000)
-            )
-            .pipe(
-                lambda x: ifr_by_neuron(
-                    df=x,
-                    neuron_col="cluster_id",
-                    spiketime_col="spike_times_seconds",
-                    ifr_fs=ifr_fs,
-                    t_start=0,
-                )
-            )
-            .rename(columns={"time": "timepoint_s"})
+        """
+        - instantaneous firing rate of every neuron sampled at ifr_fs
+        - spike times are converted to seconds using the probe sampling rate fs
+        - returns df with cols timepoint_s, ifr, cluster_id
+        """
+        return ifr_by_neuron(
+            spike_times_s=spike_times["spike_time_samples"].values / fs,
+            cluster_ids=spike_times["cluster_id"].values,
+            ifr_fs=ifr_fs,
+            t_start=0,
         )
@@ -1,7 +1,15 @@
 from .utils import _prep_db, make_filename
 from .errors import DuplicateError, CurruptDataError
 from .continuous_block import ContinuousBlock
+from .continuous_tools import pack_chunked
+from .kilosort import KilosortDir
 from .signals import AnalogSignal, DiscreteSignal
+from .event_index import EventIndex
+from .stages import run_stages
+from .checkpoints import CheckpointManifest
+from .reference_cache import reference_cache
+from sqlalchemy.orm.exc import NoResultFound
+from .spectrogram import Spectrogram
 from .processors import (
     AnalogSignalProcessor,
     DiscreteSignalProcessor,
@@ -22,6 +30,33 @@ from datetime import time, date
 dotenv.load_dotenv()
 
 
+def resolve_experimental_paths(exp_paths, experiment_name, session_name):
+    """
+    - absolute experimental paths of a recording session keyed by path type,
+      from the (path_type, path_value) rows of its experiment
+    - nothing is created on disk
+    """
+    home_dirs = [
+        path_value for path_type, path_value in exp_paths if path_type == "exp_home_dir"
+    ]
+    if len(home_dirs) != 1:
+        raise NoResultFound(
+            f"Expected one exp_home_dir for {experiment_name}, "
+            f"found {len(home_dirs)}"
+        )
+    paths: dict = {}
+    paths["PIPELINE_HOME"] = Path(os.environ.get("PIPELINE_HOME"))
+    paths["exp_home_dir"] = paths["PIPELINE_HOME"].joinpath(home_dirs[0])
+
+    for path_type, path_value in exp_paths:
+        if path_type == "exp_home_dir":
+            continue
+        paths[path_type] = paths["exp_home_dir"].joinpath(path_value)
+
+    paths["kilosort_dir"] = paths["dat_file_dir"].joinpath(session_name)
+    return paths
+
+
 class RecordingSession:
     def __init__(
         self,
@@ -37,18 +72,23 @@ class RecordingSession:
         self.config = config
         if analog_signals is not None:
             self.analog_signals = [
-                AnalogSignal(**asig, continuous_prefix=self.config["continuous_prefix"])
+                AnalogSignal(
+                    **{"salvage": self.config.get("salvage_corrupt", False), **asig},
+                    continuous_prefix=self.config["continuous_prefix"],
+                )
                 for asig in analog_signals
             ]
         else:
             self.analog_signals = analog_signals
 
+        self.event_index = EventIndex()
         if discrete_signals is not None:
             self.discrete_signals = [
                 DiscreteSignal(
                     **dsig,
                     continuous_prefix=self.config["continuous_prefix"],
                     session_name=self.meta["session_name"],
+                    event_index=self.event_index,
                 )
                 for dsig in discrete_signals
             ]
@@ -86,6 +126,12 @@ class RecordingSession:
         finally:
             logger.debug(f"{self}: closing transaction")
             session.close()
+        self.checkpoints = CheckpointManifest(
+            self.paths["extracted_dir"].joinpath(
+                make_filename(self.meta["session_name"], "checkpoints", ext=".json")
+            ),
+            enabled=self.config.get("checkpoints", False),
+        )
 
     def _duplicate_check(self, session):
         logger.info(f"Checking for duplicates: {self}")
@@ -118,55 +164,26 @@ class RecordingSession:
 
     def set_group_id(self, session):
         group_name = self.meta["experimental_group_name"]
-        self.group_id = (
-            session.query(self.orm.experimental_groups)
-            .filter(self.orm.experimental_groups.group_name == group_name)
-            .one()
-            .id
-        )
+        self.group_id = reference_cache.group_id(session, self.orm, group_name)
 
     def set_chan_map_id(self, session):
         chan_map_name = self.config["probe"]["chan_map_name"]
-        self.chan_map_id = (
-            session.query(self.orm.chan_maps)
-            .filter(self.orm.chan_maps.chan_map_name == chan_map_name)
-            .one()
-            .id
-        )
+        self.chan_map_id = reference_cache.chan_map_id(session, self.orm, chan_map_name)
 
     def set_experimental_paths(self, session):
         """
-        - populates the dict self.paths with the experimental paths 
-          by querying the db
-        - extends them to be absolute
+        - populates the dict self.paths with the experimental paths
+          from the reference cache
+        - extends them to be absolute and creates them
         """
         logger.info(f"Setting experimental paths: {self}")
-        exp_paths = (
-            session.query(self.orm.experimental_paths)
-            .join(self.orm.experiments)
-            .filter(
-                self.orm.experiments.experiment_name == self.meta["experiment_name"]
-            )
-        )
-        home_dir = (
-            exp_paths.filter(self.orm.experimental_paths.path_type == "exp_home_dir")
-            .one()
-            .path_value
-        )
-        sub_dirs = exp_paths.filter(
-            self.orm.experimental_paths.path_type != "exp_home_dir"
+        exp_paths = reference_cache.experimental_paths(
+            session, self.orm, self.meta["experiment_name"]
         )
-
-        self.paths["PIPELINE_HOME"] = Path(os.environ.get("PIPELINE_HOME"))
-        self.paths["exp_home_dir"] = self.paths["PIPELINE_HOME"].joinpath(home_dir)
-
-        for sub_dir in sub_dirs:
-            path_type = sub_dir.path_type
-            path_value = sub_dir.path_value
-            self.paths[path_type] = self.paths["exp_home_dir"].joinpath(path_value)
-
-        self.paths["kilosort_dir"] = self.paths["dat_file_dir"].joinpath(
-            self.meta["session_name"]
+        self.paths.update(
+            resolve_experimental_paths(
+                exp_paths, self.meta["experiment_name"], self.meta["session_name"]
+            )
         )
         self.dat_file = self.paths["kilosort_dir"].joinpath(self.dat_file)
 
@@ -175,15 +192,9 @@ class RecordingSession:
 
     def set_experimental_blocks(self, session):
         logger.info(f"Setting experimental blocks: {self}")
-        blocks = (
-            session.query(self.orm.experimental_blocks.block_name)
-            .join(self.orm.experiments)
-            .filter(
-                self.orm.experiments.experiment_name == self.meta["experiment_name"]
-            )
-            .order_by(self.orm.experimental_blocks.block_index)
+        self.blocks = reference_cache.experimental_blocks(
+            session, self.orm, self.meta["experiment_name"]
         )
-        self.blocks = list(map(lambda x: x[0], blocks))
 
     def make_continuous_paths_absolute(self):
         logger.info(f"Extending continuous paths: {self}")
@@ -198,52 +209,143 @@ class RecordingSession:
                 self.continuous_blocks, self.paths["extracted_dir"]
             )
 
+    def pack_dat_file(self, channels=None):
+        """
+        - streams the probe channels of each block, in block order, into the
+          interleaved int16 .dat file at self.dat_file
+        - channels defaults to config["dat_channels"], or all CH channels; it
+          is not kept under config["probe"], whose values are inserted as
+          scalar recording_session_config rows
+        """
+        logger.info(f"Packing dat file: {self}")
+        if channels is None:
+            channels = self.config.get("dat_channels", "all")
+        continuous_blocks = {
+            continuous_block.block_name: continuous_block
+            for continuous_block in self.continuous_blocks
+        }
+        folders = [
+            continuous_blocks[block].path
+            for block in self.blocks
+            if block in continuous_blocks
+        ]
+        return pack_chunked(
+            folders,
+            self.dat_file,
+            channels=channels,
+            source=self.config["continuous_prefix"],
+        )
+
     def process_block_lengths(self):
         """
         - for each continuous block creates a dictionary
-        - dict has keys: {"block_name", "block_start", "block_length"}
-        - saves the block lengths to extracted as a json
-        - adds path "block_lengths" to self.paths
+        - dict has keys: {"block_name", "block_start", "block_length",
+          "first_timestamp", "last_timestamp", "sampling_rate"}
+        - restored from the checkpoint manifest if the CH3 files are unchanged
         """
         logger.info(f"Processing block lengths: {self}")
+        salvage = self.config.get("salvage_corrupt", False)
+        fingerprint = self.checkpoints.fingerprint(
+            [
+                continuous_block.path.joinpath(
+                    make_filename(
+                        self.config["continuous_prefix"], "CH3", ext=".continuous"
+                    )
+                )
+                for continuous_block in self.continuous_blocks
+            ],
+            blocks=self.blocks,
+            salvage=salvage,
+        )
+        state = self.checkpoints.restore("block_lengths", fingerprint)
+        if state is not None:
+            self.block_lengths = state["block_lengths"]
+            return
 
         processor = BlockTimesProcessor()
         try:
             block_lengths = processor.get_block_lengths(
-                continuous_blocks=self.continuous_blocks, blocks=self.blocks,
+                continuous_blocks=self.continuous_blocks,
+                blocks=self.blocks,
+                salvage=salvage,
             )
         except CurruptDataError as e:
-            raise e("Corrupt block Lengths. Unusable data")
+            raise CurruptDataError("Corrupt block Lengths. Unusable data") from e
         self.block_lengths = block_lengths
+        self.checkpoints.save(
+            "block_lengths", fingerprint, state={"block_lengths": block_lengths}
+        )
 
     def process_analog_signals(self):
         """
         - for each signal in self.analog_signals:
         -   downsamples each continuous file and concatenates them together
-        -   calculates stft of the downsampled signal
+        -   calculates stft of the downsampled signal, kept as a compact
+            Spectrogram capped at config["stft_max_frequency"] if set
         -   saves the new data to extracted and updates the signal dictionary with its path
+        - if config["batch_analog"] is set, all signals are decimated together
+          one block at a time; on corrupt data each signal is retried alone
+        - signals whose files and settings are unchanged since they were last
+          processed are restored from the checkpoint manifest
         """
         if not self.analog_signals:
             logger.error(f"No analog signals: {self}")
             return
 
         logger.info(f"Processing analog signals: {self}")
+        fingerprints: dict = {}
+        stale_signals: list = []
         for signal in self.analog_signals:
-            logger.debug(f"Processing: {signal}")
+            fingerprints[signal.signal_name] = self._analog_fingerprint(signal)
+            state = self.checkpoints.restore(
+                f"analog_signals/{signal.signal_name}",
+                fingerprints[signal.signal_name],
+            )
+            if state is None:
+                stale_signals.append(signal)
+                continue
+            signal.is_corrupt = state["is_corrupt"]
+            signal.processed_data.update(
+                {key: Path(value) for key, value in state["processed_data"].items()}
+            )
 
-            processor = AnalogSignalProcessor()
+        batch_downsampled: dict = {}
+        if stale_signals and self.config.get("batch_analog", False):
             try:
-                downsampled_data = processor.downsample(
-                    blocks=self.blocks, asignal=signal, tmp_dir=self.paths["tmp_dir"],
+                batch_downsampled = AnalogSignalProcessor().downsample_batch(
+                    blocks=self.blocks,
+                    asignals=stale_signals,
+                    n_workers=self.config.get("analog_workers"),
                 )
             except CurruptDataError:
-                logger.error(f"Unable to process {signal}: contains corrupt data")
-                signal.is_corrupt = True
-                continue
-            stft = processor.stft(
+                logger.error(f"{self}: corrupt data in batch, processing signals alone")
+
+        for signal in stale_signals:
+            logger.debug(f"Processing: {signal}")
+            stage = f"analog_signals/{signal.signal_name}"
+
+            processor = AnalogSignalProcessor()
+            downsampled_data = batch_downsampled.get(signal.signal_name)
+            if downsampled_data is None:
+                try:
+                    downsampled_data = processor.downsample(
+                        blocks=self.blocks, asignal=signal
+                    )
+                except CurruptDataError:
+                    logger.error(f"Unable to process {signal}: contains corrupt data")
+                    signal.is_corrupt = True
+                    self.checkpoints.save(
+                        stage,
+                        fingerprints[signal.signal_name],
+                        state={"is_corrupt": True, "processed_data": {}},
+                    )
+                    continue
+            spectrogram = processor.stft(
                 downsampled_data["voltage"],
                 fs=signal.desired_sampling_rate,
-                fft_window=4,
+                fft_window=self.config.get("fft_window", 4),
+                compact=True,
+                max_frequency=self.config.get("stft_max_frequency"),
             )
             signal.processed_data["downsampled_data"] = self.paths[
                 "extracted_dir"
@@ -258,21 +360,37 @@ class RecordingSession:
 
             signal.processed_data["stft_data"] = self.paths["extracted_dir"].joinpath(
                 make_filename(
-                    self.meta["session_name"],
-                    signal.signal_name,
-                    "stft",
-                    ext=".feather",
+                    self.meta["session_name"], signal.signal_name, "stft", ext=""
                 )
             )
 
+            # salvaged signals mark corrupt records with NaN
             write_feather(
-                df=downsampled_data, dest=signal.processed_data["downsampled_data"]
+                df=downsampled_data.dropna().reset_index(drop=True),
+                dest=signal.processed_data["downsampled_data"],
             )
-            write_feather(
-                df=stft.dropna().drop_duplicates(),
-                dest=signal.processed_data["stft_data"],
+            spectrogram.save(signal.processed_data["stft_data"])
+            self.checkpoints.save(
+                stage,
+                fingerprints[signal.signal_name],
+                state={"is_corrupt": False, "processed_data": signal.processed_data},
+                outputs=[
+                    signal.processed_data["downsampled_data"],
+                    *Spectrogram.paths(signal.processed_data["stft_data"]).values(),
+                ],
             )
 
+    def _analog_fingerprint(self, signal):
+        return self.checkpoints.fingerprint(
+            [file_names["file_name"] for file_names in signal.file_names.values()],
+            blocks=self.blocks,
+            current_sampling_rate=signal.current_sampling_rate,
+            desired_sampling_rate=signal.desired_sampling_rate,
+            salvage=signal.salvage,
+            fft_window=self.config.get("fft_window", 4),
+            stft_max_frequency=self.config.get("stft_max_frequency"),
+        )
+
     def process_discrete_signals(self):
         if not self.discrete_signals:
             logger.error("No discrete signals to process")
@@ -281,44 +399,149 @@ class RecordingSession:
         logger.info(f"Processing discrete signals: {self}")
         for signal in self.discrete_signals:
             logger.info(f"Processing: {signal}")
+            stage = f"discrete_signals/{signal.signal_name}"
+            fingerprint = self._discrete_fingerprint(signal)
+            state = self.checkpoints.restore(stage, fingerprint)
+            if state is not None:
+                signal.is_corrupt = state["is_corrupt"]
+                if state["data_path"] is not None:
+                    signal.processed_data["data_path"] = Path(state["data_path"])
+                    signal.processed_data["data"] = self._load_events(
+                        signal.processed_data["data_path"]
+                    )
+                continue
+
             processor = DiscreteSignalProcessor()
+            spill_path = self.paths["extracted_dir"].joinpath(
+                make_filename(self.meta["session_name"], signal.signal_name, ext=".bin")
+            )
             try:
                 events = processor.process_events(
                     blocks=self.blocks,
                     discrete_signal=signal,
                     block_lengths=self.block_lengths,
-                    tmp_dir=self.paths["tmp_dir"],
+                    n_workers=self.config.get("discrete_workers", 4),
+                    max_memory=self.config.get("discrete_max_memory"),
+                    spill_path=spill_path,
                 )
             except CurruptDataError:
                 logger.error(f"Unable to process {signal}: contains corrupt data")
                 signal.is_corrupt = True
+                self.checkpoints.save(
+                    stage,
+                    fingerprint,
+                    state={"is_corrupt": True, "data_path": None},
+                )
                 continue
-            events_path = self.paths["extracted_dir"].joinpath(
-                make_filename(self.meta["session_name"], signal.signal_name, ext=".npy")
-            )
-            np.save(events_path, events)
-            signal.processed_data["data_path"] = events_path
+            signal.processed_data["data"] = events
+            if isinstance(events, np.memmap):
+                signal.processed_data["data_path"] = spill_path
+            elif self.checkpoints.enabled:
+                # events are only written out so that they can be restored
+                signal.processed_data["data_path"] = spill_path.with_suffix(".npy")
+                np.save(signal.processed_data["data_path"], events)
+            if self.checkpoints.enabled:
+                self.checkpoints.save(
+                    stage,
+                    fingerprint,
+                    state={
+                        "is_corrupt": False,
+                        "data_path": signal.processed_data["data_path"],
+                    },
+                    outputs=[signal.processed_data["data_path"]],
+                )
+
+    def _discrete_fingerprint(self, signal):
+        if signal.from_manual:
+            paths = [signal.file_name]
+        else:
+            paths = [
+                path
+                for file_names in signal.file_names.values()
+                for path in file_names.values()
+            ]
+        return self.checkpoints.fingerprint(
+            paths,
+            block_lengths=self.block_lengths,
+            channel=signal.channel,
+            event_id=signal.event_id,
+            nskip=signal.nskip,
+            threshold=signal.threshold,
+            refractory=signal.refractory,
+        )
+
+    @staticmethod
+    def _load_events(path):
+        """events saved by process_discrete_signals, as .npy or spilled raw"""
+        if path.suffix == ".bin":
+            return np.memmap(path, dtype=int, mode="r")
+        return np.load(path)
 
     def process_spikes(self):
         logger.info(f"Porcessing neurons: {self}")
+        kilosort_dir = KilosortDir(self.paths["kilosort_dir"])
+        waveform_source = self.config.get("waveform_source", "dat")
+        if waveform_source == "templates":
+            waveform_inputs = [
+                kilosort_dir.joinpath(name + ".npy")
+                for name in (
+                    "spike_templates",
+                    "amplitudes",
+                    "templates",
+                    "whitening_mat_inv",
+                    "channel_map",
+                )
+            ]
+        else:
+            waveform_inputs = [self.dat_file]
+        fingerprint = self.checkpoints.fingerprint(
+            [
+                kilosort_dir.joinpath("cluster_groups.csv"),
+                kilosort_dir.joinpath("spike_times.npy"),
+                kilosort_dir.joinpath("spike_clusters.npy"),
+                *waveform_inputs,
+            ],
+            waveform_source=waveform_source,
+            sampling_rate=self.config["probe"]["sampleing_rate"],
+        )
+        state = self.checkpoints.restore("spikes", fingerprint)
+        if state is not None:
+            self.no_neurons = state["no_neurons"]
+            self.processed_data.update(
+                {key: Path(value) for key, value in state["processed_data"].items()}
+            )
+            return
+
         processor = SpikesProcessor()
         try:
-            neurons = processor.get_neurons(kilosort_dir=self.paths["kilosort_dir"])
+            neurons = processor.get_neurons(kilosort_dir=kilosort_dir)
         except NoNeuronsError:
             logger.error(f"No Neurons found {self}")
             self.no_neurons = True
+            self.checkpoints.save(
+                "spikes", fingerprint, state={"no_neurons": True, "processed_data": {}}
+            )
             return
         spike_times = processor.get_spiketimes(
-            kilosort_dir=self.paths["kilosort_dir"], neurons=neurons
-        )
-        waveforms, chans = processor.get_waveforms_chans(
-            spike_times=spike_times, dat_file_path=self.dat_file
+            kilosort_dir=kilosort_dir, neurons=neurons
         )
+        if waveform_source == "templates":
+            waveforms, chans = processor.get_waveforms_chans_from_templates(
+                spike_times=spike_times, kilosort_dir=kilosort_dir
+            )
+        else:
+            waveforms, chans = processor.get_waveforms_chans(
+                spike_times=spike_times,
+                dat_file_path=self.dat_file,
+                n_workers=self.config.get("waveform_workers", 1),
+                max_worker_memory=self.config.get("waveform_worker_memory"),
+            )
         neurons = pd.merge(neurons, chans)
         ifr = processor.get_ifr(
             spike_times=spike_times, ifr_fs=1, fs=self.config["probe"]["sampleing_rate"]
         )
 
+        processed_data: dict = {}
         for name, df in (
             ("neurons", neurons),
             ("spiketimes", spike_times),
@@ -329,36 +552,46 @@ class RecordingSession:
                 make_filename(self.meta["session_name"], name, ext=".feather")
             )
             write_feather(df, file_name)
-            self.processed_data[name] = file_name
+            processed_data[name] = file_name
+        self.processed_data.update(processed_data)
+        self.checkpoints.save(
+            "spikes",
+            fingerprint,
+            state={"no_neurons": False, "processed_data": processed_data},
+            outputs=processed_data.values(),
+        )
 
     def process_data(self):
+        """
+        - checks for an existing entry, processes block lengths, then runs
+          the remaining processing stages with no transaction open
+        - with duplicates "skip" or "fail" an existing entry raises
+          DuplicateError before any processing; with "overwrite" it is left
+          for RecordingSessionInserter to delete in its insert transaction
+        """
         session = self.Session()
-        logger.debug(f"{self}: starting transaction")
+        logger.debug(f"{self}: starting duplicate check")
         try:
             self._duplicate_check(session=session)
         except DuplicateError as e:
-            print(e)
+            logger.info(f"{e}:\t\t{self}")
             if self.duplicates == "skip" or self.duplicates == "fail":
-                logger.debug(f"{self}: rolling_back transaction")
-                session.rollback()
                 raise
-            elif self.duplicates == "overwrite":
-                self._overwrite(session=session)
-                session.flush()
-        try:
-            self.process_block_lengths()
-            self.process_analog_signals()
-            self.process_discrete_signals()
-            self.process_spikes()
-            logger.debug(f"{self}: commiting transaction")
-            session.commit()
-        except:
-            logger.debug(f"{self}: rolling_back transaction")
-            session.rollback()
-            raise
         finally:
-            logger.debug(f"{self}: closing transaction")
+            logger.debug(f"{self}: closing duplicate check")
             session.close()
 
+        # block lengths only read CH3 record headers, and corrupt CH3 makes
+        # the session unusable, so they are checked before the heavy stages
+        self.process_block_lengths()
+        run_stages(
+            {
+                "analog_signals": (self.process_analog_signals, ()),
+                "spikes": (self.process_spikes, ()),
+                "discrete_signals": (self.process_discrete_signals, ()),
+            },
+            n_workers=self.config.get("stage_workers", 3),
+        )
+
     def __repr__(self):
         return f"<RecordingSession: {self.meta['session_name']}>"
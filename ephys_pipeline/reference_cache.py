@@ -0,0 +1,115 @@
+from .logger import logger
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from threading import Lock
+
+
+class ReferenceCache:
+    """
+    In-memory copy of the small reference tables of the db
+
+    experimental_groups, chan_maps, experiments with their paths and blocks,
+    analog_signals and discrete_signals are read in one pass the first time
+    any of them is needed, and lookups are then served from memory. A name
+    which is not found triggers one reload before NoResultFound is raised,
+    and inserters which add reference data call invalidate after commiting.
+
+    methods:
+        group_id
+        chan_map_id
+        experimental_paths
+        experimental_blocks
+        analog_signal_id
+        discrete_signal_id
+        invalidate
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._tables = None
+
+    def invalidate(self):
+        with self._lock:
+            logger.debug(f"{self}: invalidated")
+            self._tables = None
+
+    def _load(self, session, orm):
+        logger.debug(f"{self}: loading reference tables")
+        tables: dict = {
+            "groups": {},
+            "chan_maps": {},
+            "paths": {},
+            "blocks": {},
+            "analog_signals": {},
+            "discrete_signals": {},
+        }
+        for group in session.query(orm.experimental_groups):
+            tables["groups"].setdefault(group.group_name, []).append(group.id)
+        for chan_map in session.query(orm.chan_maps):
+            tables["chan_maps"].setdefault(chan_map.chan_map_name, []).append(
+                chan_map.id
+            )
+        for experiment_name, path_type, path_value in session.query(
+            orm.experiments.experiment_name,
+            orm.experimental_paths.path_type,
+            orm.experimental_paths.path_value,
+        ).join(orm.experimental_paths):
+            tables["paths"].setdefault(experiment_name, []).append(
+                (path_type, path_value)
+            )
+        for experiment_name, block_name in (
+            session.query(
+                orm.experiments.experiment_name, orm.experimental_blocks.block_name
+            )
+            .join(orm.experimental_blocks)
+            .order_by(orm.experimental_blocks.block_index)
+        ):
+            tables["blocks"].setdefault(experiment_name, []).append(block_name)
+        for signal in session.query(orm.analog_signals):
+            tables["analog_signals"].setdefault(signal.signal_name, []).append(
+                signal.id
+            )
+        for signal in session.query(orm.discrete_signals):
+            tables["discrete_signals"].setdefault(signal.signal_name, []).append(
+                signal.id
+            )
+        return tables
+
+    def _lookup(self, session, orm, table, key):
+        with self._lock:
+            if self._tables is None or key not in self._tables[table]:
+                self._tables = self._load(session, orm)
+            return self._tables[table].get(key)
+
+    def _one(self, session, orm, table, name):
+        ids = self._lookup(session, orm, table, name)
+        if not ids:
+            raise NoResultFound(f"No {table} found with name {name}")
+        if len(ids) > 1:
+            raise MultipleResultsFound(f"Multiple {table} found with name {name}")
+        return ids[0]
+
+    def group_id(self, session, orm, group_name):
+        return self._one(session, orm, "groups", group_name)
+
+    def chan_map_id(self, session, orm, chan_map_name):
+        return self._one(session, orm, "chan_maps", chan_map_name)
+
+    def analog_signal_id(self, session, orm, signal_name):
+        return self._one(session, orm, "analog_signals", signal_name)
+
+    def discrete_signal_id(self, session, orm, signal_name):
+        return self._one(session, orm, "discrete_signals", signal_name)
+
+    def experimental_paths(self, session, orm, experiment_name):
+        """list of (path_type, path_value) of the experiment"""
+        return list(self._lookup(session, orm, "paths", experiment_name) or [])
+
+    def experimental_blocks(self, session, orm, experiment_name):
+        """block names of the experiment ordered by block_index"""
+        return list(self._lookup(session, orm, "blocks", experiment_name) or [])
+
+    def __repr__(self):
+        return "<ReferenceCache>"
+
+
+reference_cache = ReferenceCache()
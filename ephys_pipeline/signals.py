@@ -1,8 +1,9 @@
 from .utils import make_filename
-from .continuous_tools import loadContinuous, loadEvents
+from .continuous_tools import loadContinuous, ContinuousFile
+from .event_index import EventIndex
+from .processors import ThresholdDetector
 from .logger import logger
 import numpy as np
-import pandas as pd
 
 
 class AnalogSignal:
@@ -14,6 +15,7 @@ class AnalogSignal:
         channel,
         continuous_prefix,
         ext=".continuous",
+        salvage=False,
     ):
         self.signal_name = signal_name
         self.current_sampling_rate = current_sampling_rate
@@ -24,6 +26,8 @@ class AnalogSignal:
         self.file_names: dict = {}
         self.processed_data: dict = {}
         self.is_corrupt = False
+        self.salvage = salvage
+        self.integrity: dict = {}
 
         if self.ext == ".continuous":
             self.file_name = make_filename(continuous_prefix, channel, ext=self.ext)
@@ -40,7 +44,34 @@ class AnalogSignal:
     def load(self, block):
         fname = self.file_names[block]["file_name"]
         logger.debug(f"{self}.load: {fname}")
-        return loadContinuous(fname)["data"].flatten()
+        ch = loadContinuous(fname, salvage=self.salvage)
+        if self.salvage:
+            self.record_integrity(block, ch["integrity"])
+        return ch["data"].flatten()
+
+    def open(self, block, dtype=float):
+        fname = self.file_names[block]["file_name"]
+        logger.debug(f"{self}.open: {fname}")
+        return ContinuousFile(fname, dtype=dtype, salvage=self.salvage)
+
+    def record_integrity(self, block, report):
+        """
+        - stores the integrity report of a salvaged block in self.integrity
+        - logs a warning if any records were bad, missing or truncated
+        """
+        self.integrity[block] = report
+        if (
+            len(report["bad_records"])
+            or report["dropped_records"]
+            or report["truncated_bytes"]
+        ):
+            logger.warning(
+                f"{self}: salvaged {block}: "
+                f"{len(report['bad_records'])} of {report['n_records']} records corrupt, "
+                f"{report['dropped_records']} records dropped, "
+                f"{len(report['discontinuities'])} timestamp discontinuities, "
+                f"{report['truncated_bytes']} trailing bytes ignored"
+            )
 
     def __repr__(self):
         return f"<AnalogSignal: {self.signal_name}>"
@@ -63,6 +94,8 @@ class DiscreteSignal:
 
     NSKIP: int = 5
     THRESHOLD: int = 3
+    # samples after a crossing which belong to the same pulse, 1ms at 30kHz
+    REFRACTORY: int = 30
 
     def __init__(
         self,
@@ -77,6 +110,10 @@ class DiscreteSignal:
         fname=None,
         dummy_ch="CH2",
         event_id=1,
+        nskip=None,
+        threshold=None,
+        refractory=None,
+        event_index=None,
     ):
 
         assert (
@@ -98,6 +135,10 @@ class DiscreteSignal:
         self.processed_data: dict = {}
         self.is_corrupt = False
         self.event_id = event_id
+        self.nskip = self.NSKIP if nskip is None else nskip
+        self.threshold = self.THRESHOLD if threshold is None else threshold
+        self.refractory = self.REFRACTORY if refractory is None else refractory
+        self.event_index = EventIndex() if event_index is None else event_index
 
         if from_analog:
             self.file_name = make_filename(
@@ -129,31 +170,24 @@ class DiscreteSignal:
     def _load_analog(self, block_name, block_start):
         fname = self.file_names[block_name]["file_name"]
         logger.debug(f"{self}._load_analog: {fname}")
-        data = loadContinuous(fname)["data"].flatten()
-        data = np.diff(data)
-        data = np.argwhere(data > self.THRESHOLD).flatten()
-        return (data[5:] + block_start).astype(int)
+        continuous_file = ContinuousFile(fname)
+        detector = ThresholdDetector(
+            threshold=self.threshold, refractory=self.refractory
+        )
+        onsets = detector.detect(continuous_file.read, continuous_file.n_samples)
+        return (onsets[self.nskip :] + block_start).astype(int)
 
     def _load_digital(self, block_name, block_start):
         fname_dummy = self.file_names[block_name]["dummy_channel"]
-        logger.debug(f"{self}._load_digital: Loading dummy_channel: {fname_dummy}")
-        first_timestamp = loadContinuous(fname_dummy)["timestamps"][0]
+        first_timestamp = self.event_index.first_timestamp(fname_dummy)
 
         fname_events = self.file_names[block_name]["file_name"]
         logger.debug(f"{self}._load_digital: Loading events: {fname_events}")
-        event_data = loadEvents(fname_events)
-
-        df = pd.DataFrame(
-            {
-                "channel": event_data["channel"],
-                "timestamps": event_data["timestamps"],
-                "eventid": event_data["eventId"],
-            }
+        timestamps = self.event_index.timestamps(
+            fname_events, channel=self.channel, event_id=self.event_id
         )
-        df = df[(df["eventid"] == self.event_id) & (df["channel"] == int(self.channel))]
-        df["timestamps"] = df["timestamps"] - first_timestamp + block_start
-
-        return df["timestamps"].iloc[5:].values.astype(int)
+        timestamps = timestamps - first_timestamp + block_start
+        return timestamps[self.nskip :].astype(int)
 
     def _load_manual(self):
         logger.debug(f"{self}._load_manual: {self.file_name}")
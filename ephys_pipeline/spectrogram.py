@@ -0,0 +1,74 @@
+from .logger import logger
+import numpy as np
+import pandas as pd
+
+
+class Spectrogram:
+    """
+    Compact STFT magnitudes of a signal
+
+    Holds a float32 [frequency, time] matrix with its frequency and time axes
+    rather than one row per cell. Saved as a triplet of .npy files sharing a
+    stem: <stem>_frequency.npy, <stem>_timepoint_s.npy and <stem>_fft_value.npy
+
+    methods:
+        band
+        to_tidy
+        save
+        load
+        paths
+    """
+
+    PARTS = ("frequency", "timepoint_s", "fft_value")
+
+    def __init__(self, frequency, timepoint_s, fft_value):
+        self.frequency = np.asarray(frequency)
+        self.timepoint_s = np.asarray(timepoint_s)
+        self.fft_value = np.asarray(fft_value, dtype=np.float32)
+        assert self.fft_value.shape == (
+            len(self.frequency),
+            len(self.timepoint_s),
+        ), "fft_value must have shape [frequency, timepoint_s]"
+
+    def band(self, max_frequency=None):
+        """Returns the spectrogram restricted to frequencies <= max_frequency"""
+        if max_frequency is None:
+            return self
+        keep = self.frequency <= max_frequency
+        return Spectrogram(self.frequency[keep], self.timepoint_s, self.fft_value[keep])
+
+    def to_tidy(self, dropna=True):
+        """
+        - returns a tidy df with columns frequency, timepoint_s, fft_value
+        - rows are ordered by timepoint_s then frequency
+        """
+        n_freqs, n_times = self.fft_value.shape
+        df = pd.DataFrame(
+            {
+                "frequency": np.tile(self.frequency, n_times),
+                "timepoint_s": np.repeat(self.timepoint_s, n_freqs),
+                "fft_value": self.fft_value.T.ravel(),
+            }
+        )
+        return df.dropna().reset_index(drop=True) if dropna else df
+
+    @classmethod
+    def paths(cls, stem):
+        """paths of the .npy files saved under stem"""
+        return {part: f"{stem}_{part}.npy" for part in cls.PARTS}
+
+    def save(self, stem):
+        logger.debug(f"{self}.save: {stem}")
+        for part, path in self.paths(stem).items():
+            np.save(path, getattr(self, part))
+        return stem
+
+    @classmethod
+    def load(cls, stem, mmap_mode=None):
+        paths = cls.paths(stem)
+        return cls(
+            **{part: np.load(path, mmap_mode=mmap_mode) for part, path in paths.items()}
+        )
+
+    def __repr__(self):
+        return f"<Spectrogram: {len(self.frequency)} x {len(self.timepoint_s)}>"
@@ -0,0 +1,39 @@
+from .logger import logger
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def run_stages(stages: dict, n_workers: int = 1):
+    """
+    Runs processing stages on a thread pool in dependency order
+
+    - stages maps a stage name to (function, names of the stages it needs)
+    - a stage is started as soon as all the stages it needs have finished,
+      so independent stages run concurrently
+    - if a stage raises, no further stages are started and the first
+      exception is re-raised once the running stages have finished
+    """
+    for name, (_, needs) in stages.items():
+        unknown = set(needs) - set(stages)
+        assert not unknown, f"Stage {name} needs unknown stages {unknown}"
+
+    done: set = set()
+    running: dict = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while len(done) < len(stages):
+            for name, (function, needs) in stages.items():
+                if name in done or name in running.values():
+                    continue
+                if set(needs) <= done:
+                    logger.debug(f"run_stages: starting {name}")
+                    running[executor.submit(function)] = name
+            assert running, f"Stages {set(stages) - done} have circular dependencies"
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    logger.debug(f"run_stages: {name} failed")
+                    wait(running)
+                    raise future.exception()
+                logger.debug(f"run_stages: finished {name}")
+                done.add(name)
@@ -1,13 +1,17 @@
 import json
 import dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from .dal import DAL_ORM
+from .dal import registry
+from .kilosort import as_kilosort_dir
 import os
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from functools import partial
 
+# number of spike windows read from the .dat file at a time
+WAVEFORM_CHUNK_SIZE = 1024
+
 
 def read_json(json_path):
     with open(json_path) as f:
@@ -29,10 +33,15 @@ def get_connection_string(environment_dict, no_db=False):
 
 
 def _prep_db(obj):
+    """
+    - sets the engine, Session factory and reflected orm of obj
+    - all three are shared by every object in the process
+    """
     dotenv.load_dotenv()
-    setattr(obj, "engine", create_engine(get_connection_string(os.environ)))
-    setattr(obj, "Session", sessionmaker(bind=obj.engine))
-    setattr(obj, "orm", DAL_ORM(engine=obj.engine))
+    engine = registry.engine(get_connection_string(os.environ))
+    setattr(obj, "engine", engine)
+    setattr(obj, "Session", registry.sessionmaker(engine))
+    setattr(obj, "orm", registry.orm(engine))
 
 
 def make_filename(*args, ext: str, sep="_"):
@@ -52,65 +61,207 @@ def load_dat_data(p, n_chans=32):
     return np.memmap(p, dtype=np.int16, shape=(shp, n_chans))
 
 
-def get_waveforms(spike_data, rd):
+def get_waveforms(
+    spike_data,
+    rd,
+    n_spks=400,
+    n_samps=240,
+    n_chans=32,
+    min_spikes=500,
+    chunk_size=WAVEFORM_CHUNK_SIZE,
+    n_workers=1,
+    max_worker_memory=None,
+):
     """Given a pandas df of spike times and the path to
     a the parent directory of the .dat file containing the raw
     data for that recording, extracts waveforms for each cluester
     and the channel on which that cluster had the highest amplitude
 
+    The first n_spks spikes of every cluster with more than min_spikes
+    spikes are gathered in a single pass over the .dat file, in file
+    order, chunk_size windows at a time. Windows running past either
+    end of the file are left out of the mean.
+
+    With n_workers > 1 the clusters are split into shards processed in a
+    pool of forkserver worker processes, each memory-mapping the .dat file
+    itself.
+    max_worker_memory, in bytes, caps the windows each worker holds at once.
+
     params:
         spike_data: pandas df of spike times and cluster ids as cols
         rd - path to raw dat file
     """
-    raw_data = load_dat_data(rd)
-    f1 = partial(_extract_waveforms, raw_data=raw_data, ret="data")
-    f2 = partial(_extract_waveforms, raw_data=raw_data, ret="")
+    cluster_ids, spike_times, cluster_index = _sample_spikes(
+        spike_data, n_spks, min_spikes
+    )
+    if max_worker_memory is not None:
+        window_bytes = n_samps * n_chans * np.dtype(np.int16).itemsize
+        chunk_size = max(int(max_worker_memory // window_bytes), 1)
+
+    if n_workers > 1 and len(cluster_ids) > 1:
+        shards = np.array_split(np.arange(len(cluster_ids)), n_workers)
+        shards = [shard for shard in shards if len(shard)]
+        jobs = []
+        for shard in shards:
+            in_shard = (cluster_index >= shard[0]) & (cluster_index <= shard[-1])
+            jobs.append(
+                (spike_times[in_shard], cluster_index[in_shard] - shard[0], len(shard))
+            )
+        # forking while the other processing stages run threads can deadlock
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("forkserver")
+        ) as executor:
+            results = executor.map(
+                partial(
+                    _waveform_worker,
+                    rd=str(rd),
+                    n_chans=n_chans,
+                    n_samps=n_samps,
+                    chunk_size=chunk_size,
+                ),
+                *zip(*jobs),
+            )
+            mean_waveforms = np.concatenate(list(results))
+    else:
+        raw_data = load_dat_data(rd, n_chans=n_chans)
+        mean_waveforms = _mean_waveforms(
+            raw_data, spike_times, cluster_index, len(cluster_ids), n_samps, chunk_size
+        )
+    return _waveforms_and_chans(cluster_ids, mean_waveforms)
 
-    spike_data = spike_data.groupby("cluster_id").filter(lambda x: len(x) > 500)
 
-    waveforms = (
-        spike_data.groupby("cluster_id")["spike_time_samples"]
-        .apply(f1, raw_data=raw_data)
-        .apply(pd.Series)
-        .reset_index()
+def get_template_waveforms(spike_data, kilosort_dir, min_spikes=500):
+    """Given a pandas df of spike times and the Kilosort output directory,
+    derives the mean waveform and peak channel of each cluster from the
+    Kilosort templates, without reading the raw .dat file
+
+    A cluster's waveform is the mean over its spikes of the unwhitened
+    template of each spike scaled by its amplitude. Clusters are kept and
+    channels chosen as in get_waveforms; channels are numbered from 1 as
+    columns of the .dat file, through channel_map.npy if present.
+
+    params:
+        spike_data: pandas df of spike times and cluster ids as cols
+        kilosort_dir: path to the directory holding the Kilosort outputs,
+                      or a KilosortDir
+    """
+    kilosort_dir = as_kilosort_dir(kilosort_dir)
+    counts = spike_data["cluster_id"].value_counts()
+    cluster_ids = np.sort(counts.index[counts > min_spikes].values)
+    templates = kilosort_dir.templates
+
+    # amplitude-weighted template counts per (cluster, template) pair
+    spikes, cluster_index = kilosort_dir.select(cluster_ids)
+    pairs, pair_index = np.unique(
+        cluster_index.astype(np.int64) * len(templates)
+        + kilosort_dir.spike_templates[spikes],
+        return_inverse=True,
     )
+    pair_amplitudes = np.bincount(pair_index, weights=kilosort_dir.amplitudes[spikes])
+    pair_clusters, pair_templates = np.divmod(pairs, len(templates))
+
+    used, template_index = np.unique(pair_templates, return_inverse=True)
+    unwhitened = np.asarray(templates[used]) @ kilosort_dir.whitening_mat_inv
 
-    chans = (
-        spike_data.groupby("cluster_id")["spike_time_samples"]
-        .apply(f2, raw_data=raw_data)
-        .apply(pd.Series)
-        .reset_index()
+    mean_waveforms = np.zeros((len(cluster_ids),) + unwhitened.shape[1:])
+    np.add.at(
+        mean_waveforms,
+        pair_clusters,
+        unwhitened[template_index] * pair_amplitudes[:, np.newaxis, np.newaxis],
     )
+    n_spikes = np.bincount(cluster_index, minlength=len(cluster_ids))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_waveforms /= n_spikes[:, np.newaxis, np.newaxis]
 
-    chans.columns = ["cluster_id", "channel"]
-    waveforms.columns = ["cluster_id", "waveform_index", "waveform_value"]
+    waveforms, chans = _waveforms_and_chans(cluster_ids, mean_waveforms)
+    channel_map = kilosort_dir.channel_map
+    if channel_map is not None:
+        chans["channel"] = channel_map[chans["channel"].values - 1] + 1
     return waveforms, chans
 
 
-def _extract_waveforms(
-    spk_tms, raw_data, ret="data", n_spks=400, n_samps=240, n_chans=32
+def _waveform_worker(
+    spike_times, cluster_index, n_clusters, rd, n_chans, n_samps, chunk_size
 ):
-    if len(spk_tms) < n_spks:
-        return np.nan
-    spk_tms = spk_tms.values
-    window = np.arange(int(-n_samps / 2), int(n_samps / 2))
-    wvfrms = np.zeros((n_spks, n_samps, n_chans))
-    for i in range(n_spks):
-        srt = int(spk_tms[i] + window[0])
-        end = int(spk_tms[i] + window[-1] + 1)
-        srt = srt if srt > 0 else 0
-        try:
-            wvfrms[i, :, :] = raw_data[srt:end, :]
-        except ValueError:
-            filler = np.empty((n_samps, n_chans))
-            filler[:] = np.nan
-            wvfrms[i, :, :] = filler
-    wvfrms = pd.DataFrame(np.nanmean(wvfrms, axis=0), columns=range(1, n_chans + 1))
-    norm = wvfrms - np.mean(wvfrms)
-    tmp = norm.apply(np.min, axis=0)
-    good_chan = tmp.idxmin()
-    wvfrms = wvfrms.loc[:, int(good_chan)]
-    if ret == "data":
-        return wvfrms
-    else:
-        return good_chan
+    """mean waveforms of one shard of clusters, run in a worker process"""
+    raw_data = load_dat_data(rd, n_chans=n_chans)
+    return _mean_waveforms(
+        raw_data, spike_times, cluster_index, n_clusters, n_samps, chunk_size
+    )
+
+
+def _sample_spikes(spike_data, n_spks, min_spikes):
+    """
+    - the first n_spks spike times of each cluster with more than min_spikes spikes
+    - returns sorted cluster ids, spike times and each spike's index into
+      the cluster ids
+    """
+    counts = spike_data["cluster_id"].value_counts()
+    keep = counts.index[(counts > min_spikes) & (counts >= n_spks)]
+    sampled = (
+        spike_data[spike_data["cluster_id"].isin(keep)]
+        .groupby("cluster_id")
+        .head(n_spks)
+    )
+    cluster_ids, cluster_index = np.unique(
+        sampled["cluster_id"].values, return_inverse=True
+    )
+    spike_times = sampled["spike_time_samples"].values.astype(np.int64)
+    return cluster_ids, spike_times, cluster_index
+
+
+def _mean_waveforms(
+    raw_data, spike_times, cluster_index, n_clusters, n_samps, chunk_size
+):
+    """
+    - mean [sample, channel] window around the spikes of each cluster
+    - windows are read sorted by file offset with fancy indexing, chunk_size
+      at a time, and summed per cluster
+    - returns a [cluster, sample, channel] array of means, NaN for clusters
+      without a complete window
+    """
+    n_rows, n_chans = raw_data.shape
+    starts = spike_times - n_samps // 2
+    complete = (starts >= 0) & (starts + n_samps <= n_rows)
+    order = np.argsort(starts, kind="stable")
+    order = order[complete[order]]
+
+    sums = np.zeros((n_clusters, n_samps, n_chans))
+    counts = np.bincount(cluster_index[order], minlength=n_clusters)
+    window = np.arange(n_samps)
+    for chunk_start in range(0, len(order), chunk_size):
+        chunk = order[chunk_start : chunk_start + chunk_size]
+        windows = raw_data[starts[chunk, np.newaxis] + window]
+        chunk_clusters = cluster_index[chunk]
+        for cluster in np.unique(chunk_clusters):
+            sums[cluster] += windows[chunk_clusters == cluster].sum(
+                axis=0, dtype=np.float64
+            )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts[:, np.newaxis, np.newaxis]
+
+
+def _waveforms_and_chans(cluster_ids, mean_waveforms):
+    """
+    - picks the channel of each mean waveform with the most negative
+      trough relative to its mean; channels are numbered from 1
+    - returns waveforms df with cols cluster_id, waveform_index, waveform_value
+      and chans df with cols cluster_id, channel
+    """
+    has_data = ~np.isnan(mean_waveforms).all(axis=(1, 2))
+    cluster_ids, mean_waveforms = cluster_ids[has_data], mean_waveforms[has_data]
+    n_clusters, n_samps, _ = mean_waveforms.shape
+
+    norm = mean_waveforms - mean_waveforms.mean(axis=1, keepdims=True)
+    best = norm.min(axis=1).argmin(axis=1)
+
+    waveforms = pd.DataFrame(
+        {
+            "cluster_id": np.repeat(cluster_ids, n_samps),
+            "waveform_index": np.tile(np.arange(n_samps), n_clusters),
+            "waveform_value": mean_waveforms[np.arange(n_clusters), :, best].ravel(),
+        }
+    )
+    chans = pd.DataFrame({"cluster_id": cluster_ids, "channel": best + 1})
+    return waveforms, chans